@@ -70,21 +70,46 @@
 # `000` is always on.
 """
 
-from os import get_terminal_size
+__version__ = "0.1.0"
+
+from os import get_terminal_size, pread, pwrite, fstat, ftruncate, O_RDWR, O_CREAT, O_TRUNC
+from os import open as os_open, close as os_close
+from functools import partial, lru_cache
+from itertools import islice, cycle
+from collections import namedtuple, Counter
+from stat import S_ISREG
 from argparse import ArgumentParser
-from re import subn,sub
-from sys import exit
-from time import sleep
-from pprint import pprint
+from sys import exit, stderr, stdout, stdin
+from time import monotonic, perf_counter, perf_counter_ns, time, sleep, process_time
+from atexit import register as atexit_register
+from struct import pack, pack_into, unpack_from, iter_unpack, calcsize
+from mmap import mmap, ACCESS_READ
+from zlib import crc32
+from os import replace, O_RDONLY, getpid, makedirs, environ
+from os.path import expanduser, dirname
+from fcntl import lockf, LOCK_EX, LOCK_NB, LOCK_UN
+from math import ceil
+from threading import Thread, Event, Barrier, BrokenBarrierError, Lock
+from copy import copy
+# imported where used, as they take long to import and a one-shot
+# run (udev, systemd) does not need them:
+# json, pprint, platform, shlex, glob, concurrent.futures, asyncio,
+# socket, socketserver
+from signal import signal, getsignal, SIG_DFL, SIGTERM, SIGUSR1, SIGWINCH
+from weakref import WeakSet
+from os import unlink, chmod
 
 
-def parse_args():
+def make_parser():
     a=ArgumentParser()
     #a.add_argument("--is-present",help="unknown what this is")
     a.add_argument  ( "--testing", action="store_true",default=True,
                       help="uses /tmp/msirgbpy.portfile to read/write to instead of the actual device"
                     )
     
+    a.add_argument  ( "--simulate", action="store_true",default=False,
+                      help="talk to an in memory model of the NCT6795D instead of a port file"
+                    )
     a.add_argument  ( "--disable", action="store_true",default=False,
                       help="disable the RGB subsystem altogether"
                     )
@@ -113,6 +138,35 @@ def parse_args():
     a.add_argument  ( "-q","--quiet", action="store_true",default=False,
                       help=""
                     )
+    a.add_argument  ( "--stats", action="store_true",default=False,
+                      help="count port accesses and measure latencies,\n"
+                           "dumped on exit and on SIGUSR1 (to stderr or --stats-file)"
+                    )
+    a.add_argument  ( "--stats-file", type=str,default=None,
+                      help="dump the --stats as json into this file"
+                    )
+    a.add_argument  ( "--trace", type=str,default=None,
+                      help="record every port access into this file (binary, see Thing.Tracer)"
+                    )
+    a.add_argument  ( "--replay", type=str,default=None,
+                      help="play a --trace file back against the simulated chip (--simulate)\n"
+                           "or the testing portfile"
+                    )
+    a.add_argument  ( "--replay-speed", type=float,default=1.0,
+                      help="1 - original timing, 2 - twice as fast, 0 - as fast as possible"
+                    )
+    a.add_argument  ( "--verify", action="store_true",default=False,
+                      help="read back the written cells and write again those\n"
+                           "which did not take (see --stats for the counts)"
+                    )
+    a.add_argument  ( "--state-file", type=str,default="/run/msirgbpy.state",
+                      help="remembers the chip check and the pulsing init\n"
+                           "until the next boot, \"\" to check and init every run"
+                    )
+    a.add_argument  ( "--strict", action="store_true",default=False,
+                      help="conservative port access: no skipping of redundant\n"
+                           "index/bank selects and writes, dummy read before each write"
+                    )
     a.add_argument("--pulse",action='store_true',default=False,help="smooth pulsing")
     a.add_argument  (
                         "--ignorecheck",action='store_true',default=False,
@@ -137,7 +191,8 @@ def parse_args():
                     )
     a.add_argument  (
                         "--base_port",type=str,default="4e",
-                        help="Base-port to use. Values known to be in use are 4e and 2e"
+                        help="Base-port to use. Values known to be in use are 4e and 2e\n"
+                             "Several, like 4e,2e, drive all those controllers together"
                     )
     a.add_argument  (   "-i","--invhalf",type=str,default="",
                         help="syntax regex = \"^[rgb]*$\"\n"
@@ -147,8 +202,114 @@ def parse_args():
                         help="Select a internal program by number.\n"
                              "To show avaiable one, see the --show option."
                     )
+    a.add_argument  (   "-a","--anim",type=str,default=None,
+                        help="Compile an animation into the 8 hardware frames,\n"
+                             "overrides --red/--green/--blue. Syntax:\n"
+                             "static:RRGGBB , pulse:RRGGBB , blink:RRGGBB ,\n"
+                             "gradient:RRGGBB,RRGGBB[,...] , cycle:RRGGBB,RRGGBB[,...] ,\n"
+                             "keyframes:POS=RRGGBB,POS=RRGGBB[,...] (POS 0...1 of the loop).\n"
+                             "Uses --step-duration, --fade-in."
+                    )
+    a.add_argument  (   "--dither",type=str,default=None,
+                        help="Show this RRGGBB colour with 8 bit per channel by fast switching\n"
+                             "between 4 bit intensities, until interrupted.\n"
+                             "The frame rate comes from the measured write cost, or --fps."
+                    )
+    a.add_argument  (   "--fps",type=float,default=None,
+                        help="frame rate for the internal prog, overrides its default.\n"
+                             "With --anim the frame rate of the animation, played by the\n"
+                             "chip or in software, whichever the calibration says fits"
+                    )
+    a.add_argument  (   "--duration-ms",type=float,default=None,
+                        help="with --anim, the time of the 8 frames, needs the calibration"
+                    )
+    a.add_argument  (   "--calibrate",action="store_true",default=False,
+                        help="measure the port latency and, on a terminal, how long\n"
+                             "the steps of --calibrate-steps and a blink take, by\n"
+                             "pressing Enter at every red flash; saved in --calibration"
+                    )
+    a.add_argument  (   "--calibrate-steps",type=str,default="16,64",
+                        help="step durations to time with --calibrate"
+                    )
+    a.add_argument  (   "--observation",type=str,action="append",default=[],
+                        help="with --calibrate, STEP=MS: a frame of step duration STEP\n"
+                             "was timed (e.g. with a camera) at MS milliseconds"
+                    )
+    a.add_argument  (   "--calibration",type=str,default=None,
+                        help="the calibration file,\n"
+                             "default ~/.config/msirgbpy/calibration.json"
+                    )
     a.add_argument  ( "-s","--show", action="store_true",default=False,
-                      help="Show the avaiable inernal progs"
+                      help="Show the avaiable inernal progs and the compiled scenes"
+                    )
+    a.add_argument  ( "--scene", type=str,default=None,
+                      help="apply a scene (or play a prog) from the scene store"
+                    )
+    a.add_argument  ( "--scene-store", type=str,default="/var/lib/msirgbpy/scenes.bin",
+                      help="the compiled scenes, see --scene-compile"
+                    )
+    a.add_argument  ( "--scene-compile", type=str,default=None,
+                      help="compile the scenes of this file into the scene store.\n"
+                           "One scene per line, \"name: options\", the options as on the\n"
+                           "cmdline (colours, -i, -f, --step-duration, --pulse, --blink,\n"
+                           "--disable, --anim), or \"--prog N --frames N [--fps F]\""
+                    )
+    a.add_argument  ( "--frames", type=int,default=64,
+                      help="number of frames of a prog to compile into the scene store"
+                    )
+    a.add_argument  ( "--bench", action="store_true",default=False,
+                      help="Measure port operations, syscalls and time of the main entry points\n"
+                           "(use with --simulate or the testing portfile)"
+                    )
+    a.add_argument  ( "--bench-iterations", type=int,default=1000,
+                      help="calls per entry point for --bench"
+                    )
+    a.add_argument  ( "--bench-output", type=str,default=None,
+                      help="write the --bench results as json into this file"
+                    )
+    a.add_argument  ( "--bench-baseline", type=str,default=None,
+                      help="compare the --bench results with this json file of an earlier run"
+                    )
+    a.add_argument  ( "--dump", type=str,default=None,choices=('hex','json','raw'),
+                      help="read the banks and write them in this format\n"
+                           "to --dump-file or stdout"
+                    )
+    a.add_argument  ( "--dump-file", type=str,default=None,
+                      help="file for --dump"
+                    )
+    a.add_argument  ( "--diff", type=str,nargs=2,default=None,metavar=('OLD','NEW'),
+                      help="show the registers which differ between two --dump files (json or raw)"
+                    )
+    a.add_argument  ( "--daemon", action="store_true",default=False,
+                      help="Keep the device open and take commands from the unix socket\n"
+                           "(see --socket). Commands, one per line:\n"
+                           "color RRRRRRRR GGGGGGGG BBBBBBBB\n"
+                           "mode on|pulse|blink|disable\n"
+                           "prog NAME , stop , quit"
+                    )
+    a.add_argument  ( "--send", type=str,default=None,
+                      help="Send a command to the daemon and print the reply"
+                    )
+    a.add_argument  ( "--socket", type=str,default="/run/msirgbpy.sock",
+                      help="path of the unix socket of the daemon"
+                    )
+    a.add_argument  ( "--ring-writer", action="store_true",default=False,
+                      help="Keep the device open and write what the producers\n"
+                           "queue in the shared memory ring (see --ring)"
+                    )
+    a.add_argument  ( "--ring-send", action="store_true",default=False,
+                      help="Queue the settings of the cmdline in the ring\n"
+                           "instead of writing them to the device"
+                    )
+    a.add_argument  ( "--ring", type=str,default="/dev/shm/msirgbpy.ring",
+                      help="the shared memory ring of --ring-writer"
+                    )
+    a.add_argument  ( "--priority", type=int,default=0,
+                      help="with --ring-send, the settings of higher priorities win"
+                    )
+    a.add_argument  ( "--hold", type=float,default=0,
+                      help="with --ring-send, the settings are dropped after\n"
+                           "this many seconds; 0 makes them permanent"
                     )
     a.add_argument  (
                         "-f","--fade-in",type=str,default="",
@@ -157,11 +318,16 @@ def parse_args():
                              "(only works on some boards)"
                     )
     
+    return a
+
+def parse_args():
     global args
-    args=a.parse_args()
+    args=make_parser().parse_args()
+
+args=None
 
 def dp(msg,postfix):
-    if not args.debug:
+    if args is None or not args.debug:
         return
     with open('/tmp/debuglog_'+str(postfix),'at') as dlf:
         dlf.write(msg)
@@ -175,7 +341,7 @@ class Thing():
     RGB_BANK=0x12
 
     banks = [
-                (RGB_BANK,  0xd0,   0x1000),
+                (RGB_BANK,  0xd0,   0x100),
                 (0x09,      0x20,   0x40),
                 (0x0b,      0x60,   0x70),
             ]
@@ -189,16 +355,145 @@ class Thing():
     REDCELL       = 0xf0
     GREENCELL     = 0xf4
     BLUECELL      = 0xf8
+    E4CELL        = 0xe4
+    FECELL        = 0xfe
+    FFCELL        = 0xff
+
+    # index into E4_TABLE, the values of E4 (`P` bits)
+    MODES = { 'on' : 0, 'disable' : 1, 'blink' : 2, 'pulse' : 3 }
+    E4_TABLE = bytes(( 0, 1, 2, 0b1000 ))
+
+    CHANNELS = "rgb"
+    # channel strings, as the setters store them, to bitmasks r=1 g=2 b=4
+    CHANNEL_MASKS = { ''.join( c for i,c in enumerate("rgb") if m >> i & 1 ) : m
+                      for m in range(8) }
+
+    # the parameters of set()
+    SETTINGS = ( 'red', 'green', 'blue', 'invert', 'fade_in', 'step_duration', 'mode' )
+
+    # back from register values to the settings
+    MODE_OF_E4 = dict(zip(E4_TABLE,MODES))
+    CHANNELS_OF_MASK = tuple(CHANNEL_MASKS)
+
+    def _ff_val(i,enable_bitmask=only_rgb_header_not_on_board_enable_bitmask):
+        """
+        # FF for index `tfffiii`: t the extra step duration bit,
+        # fff the fade-in mask, iii the invert mask.
+        """
+        extra_step_duration_bit = i >> 6 & 1
+        ff_fade_in_val = 0b11100000 & ~((i >> 3 & 0b111) << 5) # no fading in at all, but ...
+        ff_invert_val = (i & 0b111) << 2
+        return extra_step_duration_bit \
+                | enable_bitmask \
+                | ff_invert_val \
+                | ff_fade_in_val
+        """
+        #    let ff_fade_in_val = 0b11100000u8 & // no fading in at all.
+        #        if fade_in.contains(&"b") { !0b10000000 } else { !0 } &
+        #        if fade_in.contains(&"g") { !0b01000000 } else { !0 } &
+        #        if fade_in.contains(&"r") { !0b00100000 } else { !0 };
+        
+        #    let ff_invert_val = 0u8 |
+        #        if invs.contains(&"b") { 0b00010000 } else { 0 } |
+        #        if invs.contains(&"g") { 0b00001000 } else { 0 } |
+        #        if invs.contains(&"r") { 0b00000100 } else { 0 } ;
+        """
+    FF_TABLE = bytes(map(_ff_val,range(128)))
+    del _ff_val
+
+    # the cells of the rgb bank write_data() is responsible for,
+    # in the order they get written (and in the order of self.data['image'])
+    RGB_BANK_CELLS = ( E4CELL, FECELL, FFCELL ) + tuple(range(REDCELL,BLUECELL+4))
+    # where the colour words are in self.data['image']
+    IMAGE_OFFSETS = {   'red'   : RGB_BANK_CELLS.index(REDCELL),
+                        'green' : RGB_BANK_CELLS.index(GREENCELL),
+                        'blue'  : RGB_BANK_CELLS.index(BLUECELL) }
     
     # settings
-    check_rgb_enabled_all_time=True
+    check_rgb_enabled_all_time=True # only in strict mode, otherwise checked once
     default_portfilepath="/dev/port"
     testing_portfilepath="/tmp/msirgbpy.portfile"
+    testing_portfilesize=0x10000 # the whole io port space
 
     class Printer():
-        def __init__(self):
-            print()
+        """
+        # Prints, wrapping at the terminal width.
+        # The width is asked on the first print to a terminal, then cached
+        # and updated on SIGWINCH (if nobody else handles it).
+        # Output is collected and written in blocks of BLOCKSIZE,
+        # see flush(); what is left is flushed at exit. If the output
+        # is no terminal, the text is written as it is.
+        #
+        # There is one SIGWINCH handler and one exit flush for all
+        # printers, set up on first use, see _live.
+        """
+        BLOCKSIZE=4096
+
+        # the printers which printed to a terminal or have output buffered
+        _live=WeakSet()
+        _winch_handled=False
+        _exit_flush_registered=False
+
+        def __init__(self,out=None):
+            self.out=stdout if out is None else out
+            self.tty=self.out.isatty()
             self.hpos=0
+            self.width=None
+            self.buf=[]
+            self.buflen=0
+
+        @classmethod
+        def _flush_all(cls):
+            for printer in list(cls._live):
+                printer.flush()
+
+        @classmethod
+        def _update_widths(cls,*z):
+            for printer in list(cls._live):
+                if not printer.width is None:
+                    printer._update_width()
+
+        def _get_width(self):
+            if self.width is None:
+                self.width=80
+                self._update_width()
+                self._live.add(self)
+                cls=type(self)
+                if not cls._winch_handled:
+                    cls._winch_handled=True
+                    try:
+                        if getsignal(SIGWINCH) in (SIG_DFL,None):
+                            signal(SIGWINCH,cls._update_widths)
+                    except ValueError:
+                        pass # not in the main thread
+            return self.width
+
+        def _update_width(self,*z):
+            try:
+                width=get_terminal_size(self.out.fileno()).columns
+            except OSError:
+                return
+            if width > 0:
+                self.width=width
+
+        def write(self,txt):
+            if not self.buf:
+                self._live.add(self)
+                cls=type(self)
+                if not cls._exit_flush_registered:
+                    cls._exit_flush_registered=True
+                    atexit_register(cls._flush_all)
+            self.buf.append(txt)
+            self.buflen+=len(txt)
+            if self.buflen >= self.BLOCKSIZE:
+                self.flush()
+
+        def flush(self):
+            if self.buf:
+                self.out.write(''.join(self.buf))
+                self.buf.clear()
+                self.buflen=0
+            self.out.flush()
 
         def print(self,*z,end='',indent=0,**zz):
             """
@@ -210,68 +505,445 @@ class Thing():
             the essential functionality.
             """
             txt = str(*z)+end
+            if not self.tty:
+                self.write(txt)
+                return
             #dp("<pos="+str(self.hpos)+">txt="+repr(txt),1)
-            newline_pos_r=-1
-            for i in range(len(txt)-1,-1,-1):
-                if txt[i] == "\n" :
-                    newline_pos_r=i
-                    break
-        
-            newline_pos_l=-1
-            for i in range(len(txt)):
-                if txt[i] == "\n" :
-                    newline_pos_l=i
-                    break
-        
-            w = get_terminal_size().columns
-            l=len(sub('\\n',"",txt))
-        
-            if newline_pos_r != -1 or newline_pos_l != -1:
+            w = self._get_width()
+            newline_pos_l=txt.find("\n")
+
+            if newline_pos_l != -1:
                 # newline somewhere, need to check
-        
+                # the last newline, searched back to the first one
+                newline_pos_r=txt.rfind("\n",newline_pos_l)
+
                 if newline_pos_l + self.hpos > w:
                     #dp("<#d1#>",0)
                     # first newline would break to late
                     # so make fresh line
                     txt="\n"+" "*indent+txt
-                    print(txt,end="")
+                    self.write(txt)
                     self.hpos=indent
                 else:
                     #dp("<d2>",0)
                     # need to attend, that
                     # pos is not self.hpos+len(txt) after print
-                    print(txt,end="")
-                    self.hpos = (l-newline_pos_r)
-                    #dp("<pos="+str(self.hpos)+">",0)
-                    #dp("<npr="+str(newline_pos_r)+">",0)
-                    #dp("<l="+str(l)+">",0)
+                    self.write(txt)
+                    self.hpos = len(txt)-newline_pos_r-1
             else:
                 # no newlines
                 # so pos is self.hpos+len(txt) after print
+                l=len(txt)
                 hpos_future=self.hpos+l
                 if hpos_future > w:
-                    print("\n"+" "*indent,end="")
+                    self.write("\n"+" "*indent)
                     self.hpos=indent
-                print(txt,end="",**zz)
+                self.write(txt)
                 self.hpos+=l
 
+    class SimulatedChip():
+        """
+        # In memory model of the NCT6795D, as seen through the port file.
+        # Can be given to Device instead of a port file path.
+        #
+        # Only the index/data port pair at base_port is modeled,
+        # other ports read ff and ignore writes.
+        # `87 87` to the index port enters the advanced mode, `AA` leaves it.
+        # Outside of the advanced mode the data port reads ff and ignores writes.
+        # Registers 00...2f are global (20/21 is the chip id, 07 selects
+        # the logical device), 30...ff exist once per logical device.
+        """
+        REG_LDEV=0x07
+
+        def __init__(self,base_port=0x4e,chip_id=0xd352):
+            self.base_port=base_port
+            self.advanced=False
+            self._entry_count=0
+            self.index=0
+            self.global_regs=bytearray(0x30)
+            self.global_regs[Thing.REG_DEVID_MSB]=chip_id >> 8
+            self.global_regs[Thing.REG_DEVID_LSB]=chip_id & 0xff
+            self.banks={}
+
+        def bank(self,ldev):
+            """
+            # The registers of a logical device, created on first use.
+            """
+            regs=self.banks.get(ldev)
+            if regs is None:
+                regs=self.banks[ldev]=bytearray(0x100)
+            return regs
+
+        def _read(self,port):
+            if port == self.base_port:
+                return self.index if self.advanced else 0xff
+            if port != self.base_port + 1 or not self.advanced:
+                return 0xff
+            if self.index < 0x30:
+                return self.global_regs[self.index]
+            return self.bank(self.global_regs[self.REG_LDEV])[self.index]
+
+        def _write(self,port,d):
+            if port == self.base_port:
+                if not self.advanced:
+                    if d == 0x87:
+                        self._entry_count+=1
+                        if self._entry_count == 2:
+                            self.advanced=True
+                            self._entry_count=0
+                    else:
+                        self._entry_count=0
+                elif d == 0xaa:
+                    self.advanced=False
+                else:
+                    self.index=d
+            elif port == self.base_port + 1 and self.advanced:
+                if self.index < 0x30:
+                    if self.index not in (Thing.REG_DEVID_MSB,Thing.REG_DEVID_LSB):
+                        self.global_regs[self.index]=d
+                else:
+                    self.bank(self.global_regs[self.REG_LDEV])[self.index]=d
+
+        def pread(self,n,offset):
+            if n == 1:
+                return bytes((self._read(offset),))
+            return bytes(self._read(port) for port in range(offset,offset+n))
+
+        def pwrite(self,data,offset):
+            for i,d in enumerate(data):
+                self._write(offset+i,d)
+            return len(data)
+
+        def close(self):
+            pass
+
+    class Stats():
+        """
+        # Instrumentation of Device, see Device(instrument=True).
+        # Wraps methods of an instance (not the class),
+        # so there is no cost if it is not used.
+        #
+        # Latency histograms have power of two buckets in ns,
+        # bucket i counts the calls which took [2**(i-1), 2**i) ns.
+        # Phases are counted with total and max time.
+        """
+        BUCKETS=48
+
+        def __init__(self):
+            self.port_reads=Counter()
+            self.port_writes=Counter()
+            self.histograms={}
+            self.phases={}
+            self.verify=Counter() # see Thing(verify=True)
+
+        def _latency(self,name,f,ports=None):
+            hist=self.histograms.setdefault(name,[0]*self.BUCKETS)
+            last=self.BUCKETS-1
+            if ports is None:
+                def wrapper(*z,**zz):
+                    t0=perf_counter_ns()
+                    r=f(*z,**zz)
+                    hist[min((perf_counter_ns()-t0).bit_length(),last)]+=1
+                    return r
+            else:
+                def wrapper(port,*z):
+                    ports[port]+=1
+                    t0=perf_counter_ns()
+                    r=f(port,*z)
+                    hist[min((perf_counter_ns()-t0).bit_length(),last)]+=1
+                    return r
+            return wrapper
+
+        def _phase(self,name,f):
+            phase=self.phases.setdefault(name,[0,0,0])
+            def wrapper(*z,**zz):
+                t0=perf_counter_ns()
+                try:
+                    return f(*z,**zz)
+                finally:
+                    t=perf_counter_ns()-t0
+                    phase[0]+=1
+                    phase[1]+=t
+                    phase[2]=max(phase[2],t)
+            return wrapper
+
+        def instrument_device(self,dev):
+            dev._inb=self._latency('_inb',dev._inb,self.port_reads)
+            dev._outb=self._latency('_outb',dev._outb,self.port_writes)
+            dev._write_byte_to_cell=self._latency('_write_byte_to_cell',dev._write_byte_to_cell)
+            self.instrument_phases(dev,('_open','_init_stage_0','_init_stage_1'))
+
+        def instrument_phases(self,obj,names):
+            for name in names:
+                setattr(obj,name,self._phase(name,getattr(obj,name)))
+
+        def as_dict(self):
+            return  {
+                        'port_reads'    : { "{:x}".format(p):n for p,n in self.port_reads.items() },
+                        'port_writes'   : { "{:x}".format(p):n for p,n in self.port_writes.items() },
+                        'histograms_ns' : { name : { 1 << i >> 1 : n for i,n in enumerate(h) if n }
+                                            for name,h in self.histograms.items() },
+                        'phases_ns'     : { name : { 'count':c, 'total':t, 'max':m }
+                                            for name,(c,t,m) in self.phases.items() },
+                        'verify'        : dict(self.verify),
+                    }
+
+        def dump(self,path=None):
+            """
+            # As json into path, or readable to stderr.
+            """
+            if not path is None:
+                from json import dump
+                with open(path,'w') as f:
+                    dump(self.as_dict(),f,indent=1)
+                return
+            d=self.as_dict()
+            for what in ('port_reads','port_writes'):
+                print(what+": "+" ".join( p+":"+str(n) for p,n in sorted(d[what].items())),
+                      file=stderr)
+            for name,h in d['histograms_ns'].items():
+                print(name+" ns>=: "+" ".join( str(b)+":"+str(n) for b,n in h.items()),
+                      file=stderr)
+            for name,p in d['phases_ns'].items():
+                print("{}: count={} total={:.3f}ms max={:.3f}ms".format(
+                            name,p['count'],p['total']/1e6,p['max']/1e6), file=stderr)
+            if d['verify']:
+                print("verify: "+" ".join( k+":"+str(n) for k,n in sorted(d['verify'].items())),
+                      file=stderr)
+
+    class Tracer():
+        """
+        # Records the port accesses of a Device, see Device(trace=...).
+        # Like Stats it wraps the instance, no cost if not used.
+        #
+        # A record is RECORD: monotonic time, port, 0 read / 1 write, value.
+        # In memory the records go into a preallocated bytearray,
+        # with a path into a mmap of the file. Both grow by doubling.
+        # The file starts with HEADER: magic, version, number of records.
+        """
+        MAGIC=b'MSIT'
+        VERSION=1
+        HEADER='<4sII'
+        RECORD='<dHBB'
+
+        def __init__(self,path=None,capacity=0x10000):
+            self.path=path
+            self.count=0
+            self.capacity=capacity
+            self.header_size=calcsize(self.HEADER)
+            self.record_size=calcsize(self.RECORD)
+            size=self.header_size+capacity*self.record_size
+            if path is None:
+                self.buf=bytearray(size)
+            else:
+                self.fd=os_open(path,O_RDWR | O_CREAT | O_TRUNC,0o644)
+                ftruncate(self.fd,size)
+                self.buf=mmap(self.fd,size)
+            pack_into(self.HEADER,self.buf,0,self.MAGIC,self.VERSION,0)
+
+        def _grow(self):
+            self.capacity*=2
+            size=self.header_size+self.capacity*self.record_size
+            if self.path is None:
+                self.buf.extend(bytes(size-len(self.buf)))
+            else:
+                self.buf.resize(size)
+
+        def record(self,port,direction,value):
+            if self.count == self.capacity:
+                self._grow()
+            pack_into   (
+                            self.RECORD,self.buf,self.header_size+self.count*self.record_size,
+                            monotonic(),port,direction,value
+                        )
+            self.count+=1
+
+        def instrument_device(self,dev):
+            inb,outb,record=dev._inb,dev._outb,self.record
+            def traced_inb(port):
+                data=inb(port)
+                record(port,0,data[0])
+                return data
+            def traced_outb(port,data):
+                outb(port,data)
+                record(port,1,data if type(data) is int else data[0])
+            dev._inb=traced_inb
+            dev._outb=traced_outb
+
+        def to_bytes(self):
+            pack_into(self.HEADER,self.buf,0,self.MAGIC,self.VERSION,self.count)
+            return bytes(self.buf[:self.header_size+self.count*self.record_size])
+
+        def close(self):
+            """
+            # Writes the number of records and cuts the file to size.
+            """
+            if self.path is None or self.buf.closed:
+                return
+            pack_into(self.HEADER,self.buf,0,self.MAGIC,self.VERSION,self.count)
+            self.buf.flush()
+            self.buf.close()
+            ftruncate(self.fd,self.header_size+self.count*self.record_size)
+            os_close(self.fd)
+
+        @classmethod
+        def load(cls,raw):
+            """
+            # The records of a trace, as (time, port, direction, value).
+            """
+            magic,version,count=unpack_from(cls.HEADER,raw)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise Exception("not a trace file")
+            start=calcsize(cls.HEADER)
+            return list(iter_unpack(cls.RECORD,raw[start:start+count*calcsize(cls.RECORD)]))
+
+    class Snapshot():
+        """
+        # Registers of some banks, see Device.dump_banks().
+        # banks is a list of (bank, start, end),
+        # data holds the registers of all those ranges, one after the other.
+        #
+        # The raw format is RAW_MAGIC, the number of banks,
+        # a RAW_BANK header per bank and then data.
+        """
+        RAW_MAGIC=b'MSIR'
+        RAW_BANK='<BHH'
+
+        def __init__(self,banks,data):
+            self.banks=[ tuple(b) for b in banks ]
+            self.data=data
+            if len(data) != sum( e-s for bank,s,e in self.banks ):
+                raise Exception("snapshot data does not match the banks")
+
+        def ranges(self):
+            """
+            # (bank, start, end, offset in data) for every bank.
+            """
+            offset=0
+            for bank,s,e in self.banks:
+                yield bank,s,e,offset
+                offset+=e-s
+
+        def registers(self):
+            """
+            # {(bank,register):value}
+            """
+            return  { (bank,reg) : self.data[offset+reg-s]
+                      for bank,s,e,offset in self.ranges()
+                      for reg in range(s,e) }
+
+        def to_hex(self):
+            lines=[]
+            for bank,s,e,offset in self.ranges():
+                head="Bank[{:02x}]({:02x}...{:02x})=".format(bank, s, e)
+                for row in range(s & ~0xf,e,0x10):
+                    a,b=max(row,s),min(row+0x10,e)
+                    txt="   "*(a-row)+' '.join( '{:02x}'.format(d) for d in self.data[offset+a-s:offset+b-s] )
+                    lines.append(head+txt)
+                    head=" "*len(head)
+            return "\n".join(lines)
+
+        def to_json(self):
+            from json import dumps
+            return dumps({ 'banks' : [  { 'bank':bank, 'start':s, 'end':e,
+                                          'data':self.data[offset:offset+e-s].hex() }
+                                        for bank,s,e,offset in self.ranges() ] })
+
+        def to_raw(self):
+            return self.RAW_MAGIC+bytes((len(self.banks),)) \
+                    + b''.join( pack(self.RAW_BANK,*b) for b in self.banks ) \
+                    + bytes(self.data)
+
+        @classmethod
+        def load(cls,raw):
+            """
+            # From the output of to_raw() or to_json().
+            """
+            if raw.startswith(cls.RAW_MAGIC):
+                pos=len(cls.RAW_MAGIC)+1
+                banks=[]
+                for i in range(raw[pos-1]):
+                    banks.append(unpack_from(cls.RAW_BANK,raw,pos))
+                    pos+=calcsize(cls.RAW_BANK)
+                return cls(banks,bytearray(raw[pos:]))
+            from json import loads
+            d=loads(raw)
+            return cls  (
+                            [ (b['bank'],b['start'],b['end']) for b in d['banks'] ],
+                            bytearray(b''.join( bytes.fromhex(b['data']) for b in d['banks'] ))
+                        )
+
+        def diff(self,other):
+            """
+            # [(bank, register, old, new)] for the registers which differ,
+            # old or new is None if the register is only in one snapshot.
+            """
+            a,b=self.registers(),other.registers()
+            return [ (bank,reg,a.get((bank,reg)),b.get((bank,reg)))
+                     for bank,reg in sorted(a.keys() | b.keys())
+                     if a.get((bank,reg)) != b.get((bank,reg)) ]
+
     class Device():
-        def __init__(self,base_port,portfilepath,banks,printer,quiet=False,verbose=False):
+        def __init__    (
+                            self,base_port,portfilepath,banks,printer,
+                            quiet=False,verbose=False,strict=False,create=False,
+                            instrument=False,trace=None
+                        ):
             self.banks=banks
             self.verbose=verbose
             self.quiet=quiet
+            self.strict=strict
+            # what is selected in the chip, None if unknown
+            self._index=None
+            self._ldev=None
             self.base_port=base_port
             self.portfilepath=portfilepath
             self.printer=printer
+            self.create=create
+            self.fd=None
+            self.stats=None
+            if instrument:
+                self.stats=Thing.Stats()
+                self.stats.instrument_device(self)
+            self.tracer=trace
+            if not trace is None:
+                trace.instrument_device(self)
             self._open()
             self._init_stage_0()
             self._init_stage_1()
 
-        def _open(self):
+        @staticmethod
+        def open_port(portfilepath,create=False):
+            """
+            # Opens the port file unbuffered,
+            # every port access is one pread/pwrite at the port as offset.
+            # A regular file (testing) is created if create is set
+            # and sized to the io port space, so reads never hit EOF.
+            # Instead of a path, something with pread/pwrite
+            # like a SimulatedChip can be used.
+            # Returns the fd (or that thing) and pread(n,port), pwrite(data,port).
+            """
+            if hasattr(portfilepath,'pread'):
+                return portfilepath,portfilepath.pread,portfilepath.pwrite
+            flags = O_RDWR | O_CREAT if create else O_RDWR
             try:
-                self.filehandle=open(self.portfilepath,"wb+")
-            except:
-                raise Exception("could not open \""+self.portfilepath+"\"; try sudo?")
+                fd=os_open(portfilepath,flags,0o644)
+            except OSError:
+                raise Exception("could not open \""+portfilepath+"\"; try sudo?")
+            st=fstat(fd)
+            if S_ISREG(st.st_mode) and st.st_size < Thing.testing_portfilesize:
+                ftruncate(fd,Thing.testing_portfilesize)
+            return fd,partial(pread,fd),partial(pwrite,fd)
+
+        @staticmethod
+        def close_port(fd):
+            if type(fd) is int:
+                os_close(fd)
+            else:
+                fd.close()
+
+        def _open(self):
+            self.fd,self._pread,self._pwrite=self.open_port(self.portfilepath,self.create)
             """
             #pub fn open_device() -> ::Result<fs::File> {
             #    fs::OpenOptions::new().read(true).write(true).open("/dev/port")
@@ -284,6 +956,8 @@ class Thing():
                 self._outb( self.base_port, 0x87 )
             except:
                 raise Exception("could not enable advanced mode")
+            self._index=None
+            self._ldev=None
             """
             #fn run_wrap<'a>(matches: ArgMatches<'a>) -> Result<()> {
             #    let base_port = u16::from_str_radix(matches.value_of("BASEPORT")
@@ -302,7 +976,10 @@ class Thing():
             """
             These are something the built-in app does during initialization…
             Purpose unclear
+            The results are not used, so this is only done when verbose.
             """
+            if not self.verbose:
+                return
             init_stage1_verbose=False if self.quiet else self.verbose
 
             if init_stage1_verbose:
@@ -338,8 +1015,9 @@ class Thing():
             if self.verbose:
                 offset = port - self.base_port
                 self.printer.print("r({:+d},".format(offset))
-            self.filehandle.seek(port)
-            data = self.filehandle.read(1)
+            data = self._pread(1,port)
+            if len(data) != 1:
+                raise Exception("read probably failed")
             if self.verbose:
                 self.printer.print("{:02x}) ".format( int.from_bytes( data,'little' )))
             return data
@@ -361,11 +1039,11 @@ class Thing():
             if self.verbose:
                 offset = port - self.base_port
                 self.printer.print("w({:+d},".format(offset))
-            oldv=self.verbose
-            self.verbose=False
-            a = self._inb( self.base_port + 1)
-            self.verbose=oldv
-            self.filehandle.seek(port)
+            if self.strict:
+                oldv=self.verbose
+                self.verbose=False
+                a = self._inb( self.base_port + 1)
+                self.verbose=oldv
             #if args.debug==2:
                 #dp("base_port="+str(base_port)+"\n")
                 #dp("port="+str(port)+"\n")
@@ -382,44 +1060,64 @@ class Thing():
                 if self.verbose:
                     self.printer.print("failed!")
                 raise Exception("ERROR data need to be 1 byte long")
-            l=self.filehandle.write(data)
+            l=self._pwrite(data,port)
             if l != 1:
                 if self.verbose:
                     self.printer.print("failed!")
                 raise Exception("write probably failed")
+            if port == self.base_port:
+                self._index=data[0]
+            elif port == self.base_port + 1 and self._index == 0x07:
+                self._ldev=data[0]
             """
             #pub fn _outb(f: &mut fs::File, port: u16, data: u8) -> ::Result<()> {
             #    f.seek(io::SeekFrom::Start(port.into()))?;
             #    f.write(&[data])?;
             """
 
-        def print_all(self):
+        def _select_index(self,index):
+            """
+            # Writes the index register, if it not already holds index.
+            """
+            if self.strict or self._index != index:
+                self._outb(self.base_port, index)
+
+        def forget_selection(self):
+            """
+            # Something else (another process, a kernel driver) may have
+            # selected another index or bank since, so select them again.
+            """
+            self._index=None
+            self._ldev=None
+
+        def select_bank(self,bank):
+            """
+            # Selects the logical device (bank), if it is not already selected.
+            """
+            if self.strict or self._ldev != bank:
+                self._select_index( 0x07 )
+                self._outb(self.base_port + 1, bank)
+
+        def dump_banks(self,banks=None):
+            """
+            # Reads the declared ranges of the banks into a Snapshot.
+            """
+            banks=self.banks if banks is None else banks
+            data=bytearray()
             oldv=self.verbose
             self.verbose=False
-            for bank,s,e in self.banks:
-                bank_msg="Bank[{:02x}]({:02x}...{:02x})=".format(bank, s, e)
-                indent=len(bank_msg)
-                self.printer.print("\n"+bank_msg,end="",indent=indent)
-                #dp(bank_msg,2)
-                self._outbo( 0 , 0x07 )
-                self._outbo( 1 , bank )
-                for x in range(101,116):
-                    self._outbo( 0 , x )
-                    d = self._inbo( 1 )
-                    d=d[0]
-                    if x & 0xf == 0xf :
-                        ptxt="{:02x}".format(d)
-                        etxt="\n"+" "*indent
-                        self.printer.print(ptxt,end=etxt, indent=indent)
-                        #dp(ptxt+etxt,2)
-                        #dp("<d51>",2)
-                    else:
-                        ptxt="{:02x} ".format(d )
-                        self.printer.print(ptxt,end="", indent=indent)
-                        #dp(ptxt,2)
-                        #dp("<d52>",2)
-            self.printer.print(end="\n")
-            self.verbose=oldv
+            try:
+                for bank,s,e in banks:
+                    self.select_bank( bank )
+                    for x in range(s,e):
+                        self._select_index( x )
+                        data+=self._inb( self.base_port + 1 )
+            finally:
+                self.verbose=oldv
+            return Thing.Snapshot(banks,data)
+
+        def print_all(self):
+            self.printer.print("\n"+self.dump_banks().to_hex(),end="\n")
             """
             #fn print_all(f: &mut fs::File, base_port: u16) -> Result<()> {
             #    for &(bank, s, e) in &[(RGB_BANK, 0xd0, 0x100u16), (0x09, 0x20, 0x40), (0x0b, 0x60, 0x70)] {
@@ -443,7 +1141,7 @@ class Thing():
             """
             
         def _write_byte_to_cell( self, cell, data ):
-            self._outb(self.base_port, cell )
+            self._select_index( cell )
             self._outb(self.base_port + 1, data )
             """
             #fn self._write_byte_to_cell(f: &mut fs::File, base_port: u16, cell: u8, data: u8) -> Result<()> {
@@ -451,6 +1149,10 @@ class Thing():
             #    _outb(f, base_port + 1, data)
             #}
             """
+
+        def _read_byte_from_cell( self, cell ):
+            self._select_index( cell )
+            return self._inb(self.base_port + 1)
         
         def _deinit(self):
             """
@@ -460,25 +1162,70 @@ class Thing():
                 self._outb( self.base_port, 0xAA)
             except:
                 raise Exception("could not disable advanced mode")
+            self._index=None
+            self._ldev=None
             """
             #    // Disable the advanced mode.
             #    self._outb(&mut f, base_port, 0xAA).chain_err(|| "could not disable advanced mode")?;
             #    r.chain_err(|| "could not set the colour")
             #}
             """
+
+        def _close(self):
+            if self.fd is not None:
+                self.close_port(self.fd)
+                self.fd=None
+            if not self.tracer is None:
+                self.tracer.close()
     
-    def __init__(self,*z,args=None,**zz):
+    def __init__(   self,*z,args=None,base_port=0x4e,portfile=None,
+                    simulate=False,testing=False,ignorecheck=False,
+                    quiet=True,verbose=False,strict=False,stats=False,trace=None,
+                    state_file=None,verify=False,**settings ):
+        """
+        # Opens the device. Either from the cmdline arguments (args),
+        # or, for use as a library, from the parameters:
+        #
+        # portfile  - path or SimulatedChip, default depends on
+        #             simulate and testing, otherwise default_portfilepath
+        # trace     - path of a file to record the port accesses into
+        # state_file - path of a file to remember the chip check
+        #             and the pulsing init in, until the next boot
+        # verify    - read back what write_data() wrote, see _verify()
+        # settings  - initial settings, see set()
+        #
+        # The device stays open for any number of apply() until close().
+        """
         self.args=args
+        if not args is None:
+            base_port=int(args.base_port,base=16)
+            simulate=args.simulate
+            testing=args.testing and not args.simulate
+            ignorecheck=args.ignorecheck
+            quiet=args.quiet
+            verbose=args.verbose
+            strict=args.strict
+            stats=args.stats
+            trace=args.trace
+            state_file=args.state_file or None
+            verify=args.verify
+        self.simulate=simulate
+        self.testing=testing
+        self.ignorecheck=ignorecheck
+        self.quiet=quiet
+        self.verbose=verbose
         
-        if self.args.testing:
+        self.printer=self.Printer()
+
+        if not portfile is None:
+            portfilepath=portfile
+        elif simulate:
+            portfilepath=self.SimulatedChip(base_port)
+        elif testing:
             portfilepath=self.testing_portfilepath
         else:
             portfilepath=self.default_portfilepath
-
-        self.printer=self.Printer()
-
-        base_port=int(self.args.base_port,base=16)
-        if not self.args.quiet:
+        if not quiet:
             self.printer.print("base port = "+str(base_port),end="\n")
 
 
@@ -487,107 +1234,286 @@ class Thing():
                                     portfilepath,
                                     self.banks,
                                     self.printer,
-                                    quiet=self.args.quiet,
-                                    verbose=args.verbose,
+                                    quiet=quiet,
+                                    verbose=verbose,
+                                    strict=strict,
+                                    create=testing,
+                                    instrument=stats,
+                                    trace=None if trace is None else self.Tracer(trace),
                                 )
+        if self.dev.stats:
+            self.dev.stats.instrument_phases(
+                                self, ('_check_hardware','_init_pulsing','write_data') )
+
+        # the settings, changed by the set_* methods,
+        # which mark the registers they affect in _dirty
+        self.state={
+                        'red':0, 'green':0, 'blue':0, 'invert':"", 'fade_in':"",
+                        'step_duration':128, 'mode':'on'
+                    }
+        self._dirty={ 'e4', 'fe', 'ff', 'red', 'green', 'blue' }
+        self.data={}
+        if args is None:
+            self.set(**settings)
+        else:
+            self._load_args()
 
-        self._data_is_up2date=False
         self._hardware_ckecked_and_ok=False
         self._pulsing_initialized=False
         self._checked_rgb_enabled=False
+        # the chip id was read and matched, not skipped (ignorecheck, testing)
+        self._chip_identified=False
+        self.verify=verify
+        self.verify_retries=2
+        # counts of the read back cells, their mismatches, retries and failures
+        self.verify_stats=Counter() if self.dev.stats is None else self.dev.stats.verify
+        self.state_file=None
+        if not ( state_file is None or strict or type(portfilepath) != str ):
+            self.state_file=state_file
+            self._load_state_file()
+
+        # copy of what is in the RGB_BANK_CELLS of the chip,
+        # filled on first use by _read_shadow()
+        self._shadow=None
+
+        # set to make a running prog return
+        self.prog_stop=Event()
 
     def __del__(self):
+        if 'dev' in self.__dict__:
+            self.close()
+
+    def close(self):
+        """
+        # Leaves the advanced mode and closes the device.
+        """
+        self.printer.flush()
+        if self.dev.fd is None:
+            return
         self.dev._deinit()
+        self.dev._close()
 
-    def _write_color(self, cell_offset , data ):
-        self.dev._write_byte_to_cell( cell_offset, (data >> 24))
-        self.dev._write_byte_to_cell( cell_offset + 1 , (data >> 16))
-        self.dev._write_byte_to_cell( cell_offset + 2 , (data >> 8))
-        self.dev._write_byte_to_cell( cell_offset + 3 , data)
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*z):
+        self.close()
+
+    def _read_shadow(self):
         """
-        #fn self._write_color(f: &mut fs::File, base_port: u16, cell_offset: u8, data: u32) -> Result<()> {
-        #    self._write_byte_to_cell(f, base_port, cell_offset, (data >> 24) as u8)?;
-        #    self._write_byte_to_cell(f, base_port, cell_offset + 1, (data >> 16) as u8)?;
-        #    self._write_byte_to_cell(f, base_port, cell_offset + 2, (data >> 8) as u8)?;
-        #    self._write_byte_to_cell(f, base_port, cell_offset + 3, data as u8)
-        #}
+        # Fill the shadow copy of the rgb bank from the hardware.
+        # Bank 0x12 needs to be selected.
         """
+        self._shadow=bytearray(len(self.RGB_BANK_CELLS))
+        for i,cell in enumerate(self.RGB_BANK_CELLS):
+            self._shadow[i]=self.dev._read_byte_from_cell(cell)[0]
 
-    def _calc_data(self):
-        if self._data_is_up2date:
-            return
-        self.data={}
-        # prepare the cmdline arguments
-        self.data.update({ 'red'  : (int(args.red,   base=16) & 0x00000000)})
-        self.data.update({ 'green': (int(args.green, base=16) & 0x00000000)})
-        self.data.update({ 'blue' : (int(args.blue,  base=16) & 0x00000000)})
+    def invalidate_shadow(self):
+        """
+        # Forget the shadow copy, the next write_data() reads it again.
+        # Needed if something else did write to the rgb bank: like the
+        # selection (see Device.forget_selection()) the shadow copy
+        # can not see what other processes or kernel drivers do.
+        """
+        self._shadow=None
 
-        step_duration=(args.step_duration if (args.step_duration < 512) else 511) 
-        self.data.update({ 'step_duration' : step_duration })
-    
-        self.data.update({ 'invert_red'   : False if not "r" in args.invhalf else True})
-        self.data.update({ 'invert_green' : False if not "g" in args.invhalf else True})
-        self.data.update({ 'invert_blue'  : False if not "b" in args.invhalf else True})
-    
-        self.data.update({ 'fade_in_red'   : False if not "r" in args.fade_in else True})
-        self.data.update({ 'fade_in_green' : False if not "g" in args.fade_in else True})
-        self.data.update({ 'fade_in_blue'  : False if not "b" in args.fade_in else True})
-        self._calc_e4_val()
-
-        ff_fade_in_val = ~0b0
-        if self.data['fade_in_blue']:
-            ff_fade_in_val = ~0b10000000 & ff_fade_in_val
-        if self.data['fade_in_green']:
-            ff_fade_in_val = ~0b01000000 & ff_fade_in_val
-        if self.data['fade_in_red']:
-            ff_fade_in_val = ~0b00100000 & ff_fade_in_val
-        ff_fade_in_val = 0b11100000 & ff_fade_in_val # no fading in at all.
-        self.data.update({'ff_fade_in_val':ff_fade_in_val})
-
-        ff_invert_val = 0b0
-        if self.data['invert_blue']:
-            ff_invert_val = 0b00010000 & ff_invert_val
-        if self.data['invert_green']:
-            ff_invert_val = 0b00001000 & ff_invert_val
-        if self.data['invert_red']:
-            ff_invert_val = 0b00000100 & ff_invert_val
-        self.data.update({'ff_invert_val':ff_invert_val})
-
-        self._calc_ff_val()
-
-        self._data_is_up2date=True
+    def set_color(self,red=None,green=None,blue=None):
+        """
+        # The 32 bit words of the RR, GG, BB cells (see pack_frames()),
+        # None keeps the channel as it is.
+        """
+        for name,value in (('red',red),('green',green),('blue',blue)):
+            if value is None:
+                continue
+            value&=0xffffffff
+            if self.state[name] != value:
+                self.state[name]=value
+                self._dirty.add(name)
 
+    @classmethod
+    def canonical_settings(cls,settings):
         """
-        #    let ff_fade_in_val = 0b11100000u8 & // no fading in at all.
-        #        if fade_in.contains(&"b") { !0b10000000 } else { !0 } &
-        #        if fade_in.contains(&"g") { !0b01000000 } else { !0 } &
-        #        if fade_in.contains(&"r") { !0b00100000 } else { !0 };
-        
-        #    let ff_invert_val = 0u8 |
-        #        if invs.contains(&"b") { 0b00010000 } else { 0 } |
-        #        if invs.contains(&"g") { 0b00001000 } else { 0 } |
-        #        if invs.contains(&"r") { 0b00000100 } else { 0 } ;
+        # The settings (see set()) as the setters store them, checked
+        # without touching a Thing; None values (keep as it is) are dropped.
+        """
+        unknown=settings.keys()-set(cls.SETTINGS)
+        if unknown:
+            raise Exception("unknown settings "+", ".join(sorted(unknown)))
+        settings={ k:v for k,v in settings.items() if not v is None }
+        for name in ('red','green','blue'):
+            if name in settings:
+                settings[name]=int(settings[name]) & 0xffffffff
+        for name in ('invert','fade_in'):
+            if name in settings:
+                settings[name]=cls.canonical_channels(settings[name])
+        if 'step_duration' in settings:
+            settings['step_duration']=max(0,min(int(settings['step_duration']),511))
+        if 'mode' in settings and not settings['mode'] in cls.MODES:
+            raise Exception("unknown mode "+repr(settings['mode']))
+        return settings
+
+    @classmethod
+    def canonical_channels(cls,channels):
+        """
+        # A channel string in "rgb" order, as the setters store it.
+        """
+        if channels.strip(cls.CHANNELS):
+            raise Exception("channels need to match \"^[rgb]*$\", got "+repr(channels))
+        return ''.join( c for c in cls.CHANNELS if c in channels )
+
+    def _set_channels(self,name,channels):
+        channels=self.canonical_channels(channels)
+        if self.state[name] != channels:
+            self.state[name]=channels
+            self._dirty.add('ff')
+
+    def set_invert(self,channels):
+        """
+        # Inverted channels, a string like "rb".
+        """
+        self._set_channels('invert',channels)
+
+    def set_fade_in(self,channels):
+        """
+        # Channels with fade-in, a string like "rb".
+        """
+        self._set_channels('fade_in',channels)
+
+    def set_step_duration(self,step_duration):
         """
+        # 0 - fastest, 511 - slowest
+        """
+        step_duration=max(0,min(int(step_duration),511))
+        if self.state['step_duration'] != step_duration:
+            self.state['step_duration']=step_duration
+            self._dirty.update(('fe','ff'))
+
+    def set_mode(self,mode):
+        """
+        # One of the keys of MODES.
+        """
+        if not mode in self.MODES:
+            raise Exception("unknown mode "+repr(mode))
+        if self.state['mode'] != mode:
+            self.state['mode']=mode
+            self._dirty.add('e4')
+
+    def set(    self,red=None,green=None,blue=None,invert=None,fade_in=None,
+                step_duration=None,mode=None ):
+        """
+        # Calls the setters for the settings which are not None.
+        """
+        self.set_color(red,green,blue)
+        if not invert is None:
+            self.set_invert(invert)
+        if not fade_in is None:
+            self.set_fade_in(fade_in)
+        if not step_duration is None:
+            self.set_step_duration(step_duration)
+        if not mode is None:
+            self.set_mode(mode)
+
+    def _load_args(self):
+        """
+        # Takes the settings from the cmdline arguments.
+        """
+        self.set(**self.settings_of_args(self.args))
 
-    def _calc_e4_val(self):
-        self.data.update({'e4_val':None})
-        if self.args.disable:
-            self.data['e4_val']=1
-        elif self.args.pulse:
-            self.data['e4_val']=0b1000
-        elif not self.args.blink == 0:
-            self.data['e4_val']=(self.args.blink + 1) & 0b111
+    @staticmethod
+    def settings_of_args(a):
+        """
+        # The settings (see set()) given by the cmdline arguments.
+        """
+        if a.disable:
+            mode='disable'
+        elif a.pulse:
+            mode='pulse'
+        elif a.blink:
+            mode='blink'
         else:
-            self.data['e4_val']=0
+            mode='on'
+        return  {
+                    'red'           : int(a.red,base=16),
+                    'green'         : int(a.green,base=16),
+                    'blue'          : int(a.blue,base=16),
+                    'invert'        : a.invhalf,
+                    'fade_in'       : a.fade_in,
+                    'step_duration' : a.step_duration,
+                    'mode'          : mode,
+                }
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def register_image(red,green,blue,invert_mask,fade_in_mask,step_duration,mode):
+        """
+        # The values of the RGB_BANK_CELLS for the settings, in that order.
+        # Masks as in CHANNEL_MASKS, mode as in MODES. Memoized.
+        """
+        ff_index = ( step_duration >> 8 & 1 ) << 6 | fade_in_mask << 3 | invert_mask
+        return bytes    ((
+                            Thing.E4_TABLE[mode],
+                            step_duration & 0xff,
+                            Thing.FF_TABLE[ff_index],
+                        )) \
+                + red.to_bytes(4,'big') + green.to_bytes(4,'big') + blue.to_bytes(4,'big')
+
+    @classmethod
+    def image_settings(cls,image):
+        """
+        # The settings (see set()) of a register image, the reverse of register_image().
+        """
+        e4,fe,ff=image[0],image[1],image[2]
+        return  {
+                    'mode'          : cls.MODE_OF_E4[e4],
+                    'step_duration' : fe | (ff & 1) << 8,
+                    'invert'        : cls.CHANNELS_OF_MASK[ff >> 2 & 0b111],
+                    'fade_in'       : cls.CHANNELS_OF_MASK[~ff >> 5 & 0b111],
+                    'red'           : int.from_bytes(image[3:7],'big'),
+                    'green'         : int.from_bytes(image[7:11],'big'),
+                    'blue'          : int.from_bytes(image[11:15],'big'),
+                }
+
+    def apply_image(self,image):
+        """
+        # Writes a register image (see register_image()) as it is,
+        # the settings are taken back from it.
+        """
+        self._load_image(image)
+        self.write_data()
 
-    def _calc_ff_val(self):
-        extra_step_duration_bit = (self.data['step_duration'] >> 8).to_bytes(1,'little')[0] & 1
+    def _load_image(self,image):
+        self.state.update(self.image_settings(image))
+        self.data['image']=bytes(image)
+        self._dirty.clear()
 
-        ff_val = extra_step_duration_bit \
-                | self.only_rgb_header_not_on_board_enable_bitmask \
-                | self.data['ff_invert_val'] \
-                | self.data['ff_fade_in_val']
-        self.data.update({'ff_val':ff_val})
+    def _calc_data(self):
+        """
+        # Updates the registers marked in _dirty.
+        # self.data['image'] holds the values of the RGB_BANK_CELLS, in that order.
+        # If only colours changed, their words are put into the image,
+        # otherwise the whole image is looked up (register_image()).
+        """
+        dirty=self._dirty
+        if not dirty:
+            return
+        state=self.state
+        image=self.data.get('image')
+        if not image is None and dirty.isdisjoint(('e4','fe','ff')):
+            image=bytearray(image)
+            for name in dirty:
+                offset=self.IMAGE_OFFSETS[name]
+                image[offset:offset+4]=state[name].to_bytes(4,'big')
+            self.data['image']=bytes(image)
+            dirty.clear()
+            return
+        self.data['image']=self.register_image  (
+                                state['red'], state['green'], state['blue'],
+                                self.CHANNEL_MASKS[state['invert']],
+                                self.CHANNEL_MASKS[state['fade_in']],
+                                state['step_duration'],
+                                self.MODES[state['mode']],
+                            )
+        self._dirty.clear()
 
     def _check_hardware(self):
         """
@@ -595,16 +1521,16 @@ class Thing():
         """
         if self._hardware_ckecked_and_ok:
             return
-        if not self.args.ignorecheck and not self.args.testing:
-            self.dev._outbo( 0 , self.REG_DEVID_MSB)
+        if not self.ignorecheck and not self.testing:
+            self.dev._select_index( self.REG_DEVID_MSB)
             msb = self.dev._inbo( 1)
-            self.dev._outbo( 0 , self.REG_DEVID_LSB)
+            self.dev._select_index( self.REG_DEVID_LSB)
     
-            indent = ( msb[0] << 8 ) | (0x00 + self.dev._inbo( 1 )[0])
+            ident = ( msb[0] << 8 ) | (0x00 + self.dev._inbo( 1 )[0])
     
-            if self.args.verbose:
+            if self.verbose:
                 self.printer.print("Chip identifier is: {:x}".format(ident))
-            if not (indent & 0xFFF0) in self.VALID_MASKS:
+            if not (ident & 0xFFF0) in self.VALID_MASKS:
                 raise Exception (    
                                     "--ignorecheck flag, which would skip the check;"
                                     "is not specified (may be dangerous);"
@@ -614,17 +1540,73 @@ class Thing():
                                     "The sI/O chip identifies as {:x}, which does not"
                                     "seem to be NCT6795D".format(ident)
                                 )
+            self._chip_identified=True
         self._hardware_ckecked_and_ok=True
 
-    def _init_pulsing(self):
+    @staticmethod
+    def _boot_id():
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _state_key(self):
         """
-        # Without this pulsing does not work
+        # The line of the state file for this device in this boot.
         """
-        if self._pulsing_initialized:
-            return
-        self.dev._outbo( 0 , 0x07)
-        self.dev._outbo( 1 , 0x09)
-        self.dev._outbo( 0 , 0x2c)
+        boot_id=self._boot_id()
+        if boot_id is None:
+            return None
+        return "{} {:x} {}\n".format(boot_id,self.dev.base_port,self.dev.portfilepath)
+
+    def _load_state_file(self):
+        """
+        # Skip the chip check and the pulsing init if they are done
+        # for this device since the last boot, see _save_state_file().
+        """
+        key=self._state_key()
+        try:
+            with open(self.state_file) as f:
+                lines=f.readlines()
+        except OSError:
+            return
+        if not key is None and key in lines:
+            self._hardware_ckecked_and_ok=True
+            self._pulsing_initialized=True
+            self.state_file=None # nothing to save
+
+    def _save_state_file(self):
+        """
+        # Adds this device to the state file, the lines of earlier boots are dropped.
+        # Only after the chip id was actually checked, a skipped check is not saved.
+        """
+        key=self._state_key()
+        path,self.state_file=self.state_file,None
+        if key is None:
+            return
+        boot_id=key.split(' ',1)[0]
+        try:
+            with open(path) as f:
+                lines=[ l for l in f if l.split(' ',1)[0] == boot_id and l != key ]
+        except OSError:
+            lines=[]
+        tmp="{}.{:x}.tmp".format(path,self.dev.base_port)
+        try:
+            with open(tmp,'w') as f:
+                f.writelines(lines+[key])
+            replace(tmp,path)
+        except OSError:
+            pass # not root, checked again next time
+
+    def _init_pulsing(self):
+        """
+        # Without this pulsing does not work
+        """
+        if self._pulsing_initialized:
+            return
+        self.dev.select_bank( 0x09 )
+        self.dev._select_index( 0x2c )
         c = (self.dev._inbo( 1 ))[0]
         if c & 0x10 != 0x10 :
             self.dev._outbo( 1, c | 0x10)
@@ -634,38 +1616,1611 @@ class Thing():
         """
         # Select the 0x12th bank.
         """
-        self.dev._outbo( 0 , 0x07)
-        self.dev._outbo( 1 , self.RGB_BANK)
+        self.dev.select_bank( self.RGB_BANK )
     
     def _check_rgb_enabled(self):
         """
         # Check if RGB control enabled?
         """
-        if self._checked_rgb_enabled and not self.check_rgb_enabled_all_time:
+        if self._checked_rgb_enabled \
+                and not ( self.check_rgb_enabled_all_time and self.dev.strict ):
             return
-        self.dev._outbo( 0 , 0xe0)
+        self.dev._select_index( 0xe0 )
         d = self.dev._inbo( 1)[0]
         if d & 0xe0 != 0xe0 :
             self.dev._outbo(  1, 0xe0 | (d & ~0xe0))
         self._checked_rgb_enabled=True
 
-    def _prepare_data_write(self):
+    def apply(self,**settings):
+        """
+        # Changes the settings (see set()) and writes them.
+        """
+        self.set(**settings)
+        self.write_data()
+
+    def apply_frame(self,frame):
+        """
+        # A frame is a dict of settings, see set().
+        """
+        self.apply(**frame)
+
+    def write_data(self,force=False):
+        """
+        # Writes the cells which differ from the shadow copy.
+        # With force all the cells are written.
+        """
+        self._prepare_data_write(force)
+        self._commit()
+
+    def _prepare_data_write(self,force=False):
+        """
+        # Everything up to the writing of the cells.
+        # The selection is only trusted within one write, see Device.forget_selection().
+        """
+        self.dev.forget_selection()
+        force = force or self.dev.strict
+        if force:
+            # no need to read what gets overwritten anyway
+            self._shadow=bytearray(len(self.RGB_BANK_CELLS))
         self._calc_data()
         self._check_hardware()
         self._init_pulsing()
+        if not self.state_file is None and self._chip_identified:
+            self._save_state_file()
         self._select_bank_12()
         self._check_rgb_enabled()
+        if self._shadow is None:
+            self._read_shadow()
+        if force:
+            self._shadow[:]=bytes(~b & 0xff for b in self.data['image'])
 
-    def write_data(self):
-        self._prepare_data_write()
+    def _commit(self):
+        """
+        # Writes the cells which differ from the shadow copy.
+        """
+        image=self.data['image']
+        shadow=self._shadow
+        written=[]
+        for i,cell in enumerate(self.RGB_BANK_CELLS):
+            d=image[i]
+            if shadow[i] != d:
+                self.dev._write_byte_to_cell( cell, d )
+                shadow[i]=d
+                written.append(i)
+        if self.verify and written:
+            self._verify(written)
 
-        self.dev._write_byte_to_cell(  0xe4, self.data['e4_val'])
-        self.dev._write_byte_to_cell(  0xfe, self.data['step_duration'])
-        self.dev._write_byte_to_cell(  0xff, self.data['ff_val'])
-    
-        self._write_color(  self.REDCELL,   self.data['red'])
-        self._write_color(  self.GREENCELL, self.data['green'])
-        self._write_color(  self.BLUECELL,  self.data['blue'])
+    def _verify(self,written):
+        """
+        # Reads back the cells just written (indices into RGB_BANK_CELLS),
+        # in reverse order: the last written cell is still selected,
+        # so the first read needs no index write.
+        # Cells which differ are written and read again, up to
+        # verify_retries times. The shadow copy gets what is read,
+        # so cells which still differ are written by the next write_data().
+        """
+        image=self.data['image']
+        stats=self.verify_stats
+        dev=self.dev
+        cells=written[::-1]
+        for attempt in range(self.verify_retries+1):
+            if attempt:
+                stats['retries']+=len(cells)
+                for i in reversed(cells):
+                    dev._write_byte_to_cell( self.RGB_BANK_CELLS[i], image[i] )
+            stats['verified']+=len(cells)
+            bad=[]
+            for i in cells:
+                d=dev._read_byte_from_cell( self.RGB_BANK_CELLS[i] )[0]
+                self._shadow[i]=d
+                if d != image[i]:
+                    bad.append(i)
+            stats['mismatches']+=len(bad)
+            if not bad:
+                return
+            cells=bad
+        stats['failed']+=len(cells)
+        if not self.quiet:
+            print("verify: cells "+" ".join( "{:02x}".format(self.RGB_BANK_CELLS[i]) for i in cells )
+                    +" did not take",file=stderr)
+
+class ThingGroup():
+    """
+    # Several controllers (one Thing per base port) driven together.
+    # They are opened in parallel threads. For every write the
+    # preparation (checks, selects) runs in parallel too, then all
+    # threads meet at a barrier and write their cells at the same time.
+    # Offers the parts of the Thing interface the progs and the daemon use.
+    """
+    def __init__(self,base_ports,args=None,**params):
+        def open_thing(base_port):
+            if args is None:
+                return Thing(base_port=base_port,**params)
+            a=copy(args)
+            a.base_port="{:x}".format(base_port)
+            return Thing(args=a)
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor=ThreadPoolExecutor(max_workers=len(base_ports))
+        futures=[ self.executor.submit(open_thing,p) for p in base_ports ]
+        self.things=[]
+        try:
+            for f in futures:
+                self.things.append(f.result())
+        except:
+            self.close()
+            raise
+        first=self.things[0]
+        self.printer=first.printer
+        self.quiet=first.quiet
+        self.prog_stop=Event()
+
+    @property
+    def state(self):
+        """
+        # The settings, the same for all the things.
+        """
+        return self.things[0].state
+
+    def set(self,**settings):
+        for thing in self.things:
+            thing.set(**settings)
+
+    def set_color(self,red=None,green=None,blue=None):
+        self.set(red=red,green=green,blue=blue)
+
+    def set_mode(self,mode):
+        self.set(mode=mode)
+
+    def write_data(self,force=False):
+        barrier=Barrier(len(self.things))
+        def write(thing):
+            try:
+                thing._prepare_data_write(force)
+            except:
+                barrier.abort()
+                raise
+            barrier.wait()
+            thing._commit()
+        futures=[ self.executor.submit(write,thing) for thing in self.things ]
+        errors=[ f.exception() for f in futures ]
+        for e in errors:
+            if not e is None and not isinstance(e,BrokenBarrierError):
+                raise e
+
+    def apply(self,**settings):
+        self.set(**settings)
+        self.write_data()
+
+    def apply_frame(self,frame):
+        self.apply(**frame)
+
+    def apply_image(self,image):
+        for thing in self.things:
+            thing._load_image(image)
+        self.write_data()
+
+    def close(self):
+        for thing in self.things:
+            thing.close()
+        self.executor.shutdown()
+
+HwProgram = namedtuple  (   'HwProgram',
+                            ( 'red', 'green', 'blue', 'step_duration',
+                              'pulse', 'blink', 'fade_in', 'error' )
+                        )
+HwProgram.__doc__="""
+# What compile_animation() made of an animation.
+# red, green, blue are the 32 bit words for the RR, GG, BB cells,
+# fade_in the channels ("rgb") that get the fade-in bit,
+# error the rms difference (0...255 scale) between the requested
+# animation and what the chip plays.
+"""
+
+ANIM_KINDS=('static','pulse','blink','gradient','cycle','keyframes')
+
+def pack_frames(nibbles):
+    """
+    # 8 intensities (frame 0...7, 0...f) to the 32 bit word,
+    # written in the `10 32 54 76` order.
+    """
+    word=0
+    for i in range(0,8,2):
+        word = (word << 8) | ((nibbles[i+1] & 0xf) << 4) | (nibbles[i] & 0xf)
+    return word
+
+def unpack_frames(word):
+    """
+    # The reverse of pack_frames().
+    """
+    nibbles=[]
+    for shift in (24,16,8,0):
+        byte=(word >> shift) & 0xff
+        nibbles+=[ byte & 0xf, byte >> 4 ]
+    return nibbles
+
+def blend_words(a,b,f):
+    """
+    # Frame by frame mix of two RR/GG/BB words,
+    # f=0 gives a, f=1 gives b.
+    """
+    return pack_frames([ round(x+(y-x)*f) for x,y in zip(unpack_frames(a),unpack_frames(b)) ])
+
+def _lerp(a,b,f):
+    return tuple(x+(y-x)*f for x,y in zip(a,b))
+
+def _anim_color(kind,colors,t):
+    """
+    # The requested colour at time t (0...1 of the loop).
+    """
+    if kind in ('static','pulse','blink'):
+        return colors[0]
+    if kind == 'gradient':
+        if len(colors) == 1:
+            return colors[0]
+        pos=t*(len(colors)-1)
+        i=min(int(pos),len(colors)-2)
+        return _lerp(colors[i],colors[i+1],pos-i)
+    if kind == 'cycle':
+        return colors[min(int(t*len(colors)),len(colors)-1)]
+    # keyframes, sorted (pos,colour) pairs, interpolated around the loop
+    for i,(pos,color) in enumerate(colors):
+        if pos > t:
+            break
+    else:
+        i=len(colors)
+    p0,c0=colors[i-1] if i > 0 else (colors[-1][0]-1,colors[-1][1])
+    p1,c1=colors[i] if i < len(colors) else (colors[0][0]+1,colors[0][1])
+    return _lerp(c0,c1,(t-p0)/(p1-p0)) if p1 != p0 else c1
+
+def compile_animation(kind,colors,step_duration=128,fade_in="",duration_ms=None,calibration=None):
+    """
+    # Makes a HwProgram out of an animation.
+    # colors are (r,g,b) tuples (0...255), for keyframes (pos,(r,g,b)) pairs.
+    # step_duration is used as it is (clamped to 0...511), it is not
+    # fitted to the animation; with duration_ms (for all 8 frames)
+    # it is fitted with the calibration (default: Calibration.load()).
+    #
+    # Every frame gets the requested colour at its middle,
+    # quantized to 4 bit. The error is measured against the requested
+    # animation at 8 points per frame.
+    # The fade-in bit is only set for channels of fade_in
+    # which are f in all 8 frames, as the chip ignores it otherwise.
+    """
+    if not kind in ANIM_KINDS:
+        raise Exception("unknown animation "+repr(kind))
+    if not colors:
+        raise Exception("animation needs at least one colour")
+    if kind == 'keyframes':
+        colors=sorted(colors)
+    if not duration_ms is None:
+        calibration=calibration or Calibration.load()
+        step_duration=calibration.step_for_ms(duration_ms/8)
+    frames=[ [ round(c*15/255) for c in _anim_color(kind,colors,(i+0.5)/8) ]
+             for i in range(8) ]
+    sqerr=0.0
+    for i in range(64):
+        want=_anim_color(kind,colors,(i+0.5)/64)
+        got=frames[i//8]
+        sqerr+=sum((w-g*17)**2 for w,g in zip(want,got))
+    words=[ pack_frames([ f[ch] for f in frames ]) for ch in range(3) ]
+    fade=''.join( c for ch,c in enumerate('rgb')
+                  if c in fade_in and all(f[ch] == 0xf for f in frames) )
+    return HwProgram(
+                        red=words[0], green=words[1], blue=words[2],
+                        step_duration=max(0,min(step_duration,511)),
+                        pulse = kind == 'pulse', blink = kind == 'blink',
+                        fade_in=fade, error=(sqerr/(64*3))**0.5
+                    )
+
+def parse_animation(spec,step_duration=128,fade_in="",**z):
+    """
+    # Compiles the --anim syntax, see parse_args().
+    """
+    kind,_,params=spec.partition(':')
+    def color(txt):
+        v=int(txt,base=16)
+        return ( v >> 16 & 0xff, v >> 8 & 0xff, v & 0xff )
+    colors=[]
+    for param in params.split(','):
+        if kind == 'keyframes':
+            pos,_,txt=param.partition('=')
+            colors.append((float(pos),color(txt)))
+        else:
+            colors.append(color(param))
+    return compile_animation(kind,colors,step_duration,fade_in,**z)
+
+def apply_program(thing,prog):
+    """
+    # Puts a HwProgram into the settings of thing.
+    # The mode is only set for pulse and blink programs,
+    # otherwise it stays as it is (e.g. disable).
+    """
+    thing.set   (
+                    red=prog.red, green=prog.green, blue=prog.blue,
+                    step_duration=prog.step_duration, fade_in=prog.fade_in,
+                    mode=program_mode(prog),
+                )
+
+def program_mode(prog):
+    """
+    # The mode a HwProgram needs, None if any.
+    """
+    return 'pulse' if prog.pulse else 'blink' if prog.blink else None
+
+def program_frames(prog):
+    """
+    # The 8 frames of a HwProgram as static colours (see Thing.set()),
+    # to play it in software. Pulse, blink and fade-in are left out.
+    """
+    channels=[ unpack_frames(word) for word in (prog.red,prog.green,prog.blue) ]
+    return [ { 'red':r*0x11111111, 'green':g*0x11111111, 'blue':b*0x11111111 }
+             for r,g,b in zip(*channels) ]
+
+class Calibration():
+    """
+    # What the step duration and the blink code mean in time on this
+    # host, and how long the port I/O takes. Kept as json.
+    #
+    # The chip can not be read back for its timing, so the times come
+    # from observations: a frame of step duration s took ms milliseconds,
+    # timed by pressing Enter at the flashes (observe()) or given.
+    # They are fitted with a line, ms = offset + slope*s;
+    # with a single observation as proportional to s+1.
+    """
+    VERSION=1
+    STEPS=512
+    tolerance=0.05 # how close the chip has to come to a wanted frame time
+
+    def __init__(self,data=None):
+        data=data or {}
+        self.latency=data.get('latency_us',{})
+        self.observations=[ tuple(o) for o in data.get('observations',[]) ]
+        self.blink=data.get('blink_ms',{})
+
+    @staticmethod
+    def default_path():
+        config=environ.get('XDG_CONFIG_HOME') or expanduser("~/.config")
+        return config+"/msirgbpy/calibration.json"
+
+    @classmethod
+    def load(cls,path=None):
+        """
+        # An empty calibration if there is no file.
+        """
+        from json import load
+        try:
+            with open(path or cls.default_path()) as f:
+                return cls(load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self,path=None):
+        from json import dump
+        path=path or self.default_path()
+        makedirs(dirname(path),exist_ok=True)
+        with open(path+".tmp",'w') as f:
+            dump    ({
+                        'version'       : self.VERSION,
+                        'latency_us'    : self.latency,
+                        'observations'  : self.observations,
+                        'blink_ms'      : self.blink,
+                        'time'          : time(),
+                    },f,indent=1)
+        replace(path+".tmp",path)
+
+    def add_observation(self,step_duration,ms):
+        self.observations.append((step_duration,ms))
+
+    def fit(self):
+        """
+        # (offset, slope) of the frame time in ms.
+        """
+        obs=self.observations
+        if not obs:
+            raise Exception("no calibration; run --calibrate")
+        n=len(obs)
+        ms=sum( m for s,m in obs )/n
+        st=sum( s for s,m in obs )/n
+        var=sum( (s-st)**2 for s,m in obs )
+        if var == 0:
+            slope=ms/(st+1)
+            return slope,slope
+        slope=sum( (s-st)*(m-ms) for s,m in obs )/var
+        return ms-slope*st,slope
+
+    def frame_ms(self,step_duration):
+        offset,slope=self.fit()
+        return offset+slope*step_duration
+
+    def table(self):
+        """
+        # ms per frame for every step duration.
+        """
+        offset,slope=self.fit()
+        return [ offset+slope*s for s in range(self.STEPS) ]
+
+    def step_for_ms(self,ms):
+        """
+        # The step duration of the frame time closest to ms.
+        """
+        offset,slope=self.fit()
+        if slope <= 0:
+            raise Exception("the calibration does not make sense; run --calibrate again")
+        return max(0,min(self.STEPS-1,round((ms-offset)/slope)))
+
+    def playback(self,fps,budget=0.25):
+        """
+        # ('hardware', step duration) if the chip can step at fps,
+        # ('software', None) if writing fps frames a second takes at most
+        # the budget fraction of the time, otherwise the closest hardware.
+        """
+        frame_ms=1000/fps
+        step=self.step_for_ms(frame_ms)
+        if abs(self.frame_ms(step)-frame_ms) <= self.tolerance*frame_ms:
+            return 'hardware',step
+        write_us=self.latency.get('frame')
+        if write_us is None or write_us*fps/1e6 <= budget:
+            return 'software',None
+        return 'hardware',step
+
+    def measure_latency(self,thing,n=200):
+        """
+        # us per port read, port write and software frame (a colour change).
+        # The settings of thing are written again at the end.
+        """
+        dev=thing.dev
+        saved=dict(thing.state)
+        thing.write_data()
+        t0=perf_counter()
+        for i in range(n):
+            dev._inb(dev.base_port+1)
+        self.latency['inb']=(perf_counter()-t0)/n*1e6
+        t0=perf_counter()
+        for i in range(n):
+            dev._outb(dev.base_port,thing.E4CELL) # the index, selected again
+        self.latency['outb']=(perf_counter()-t0)/n*1e6
+        frames=cycle(({ 'red':0x11111111, 'green':0, 'blue':0 },{ 'red':0, 'green':0, 'blue':0x11111111 }))
+        t0=perf_counter()
+        for frame in islice(frames,n):
+            thing.apply_frame(frame)
+        self.latency['frame']=(perf_counter()-t0)/n*1e6
+        thing.apply(**saved)
+        return self.latency
+
+    @staticmethod
+    def _time_flashes(flashes,tap):
+        times=[]
+        for i in range(flashes+1):
+            tap()
+            times.append(monotonic())
+        return (times[-1]-times[0])/flashes*1000
+
+    def observe(self,thing,step_duration,flashes=8,tap=input):
+        """
+        # Shows one red frame in 8 with step_duration; tap() returns at each
+        # flash (default: Enter). Adds and returns the ms per frame.
+        """
+        saved=dict(thing.state)
+        try:
+            thing.apply (
+                            red=pack_frames([15,0,0,0,0,0,0,0]), green=0, blue=0,
+                            invert="", fade_in="", mode='on', step_duration=step_duration
+                        )
+            ms=self._time_flashes(flashes,tap)/8
+        finally:
+            thing.apply(**saved)
+        self.add_observation(step_duration,ms)
+        return ms
+
+    def observe_blink(self,thing,flashes=8,tap=input):
+        """
+        # Like observe() for the blink mode, adds and returns the ms per blink.
+        """
+        saved=dict(thing.state)
+        try:
+            thing.apply(red=0xffffffff, green=0, blue=0, invert="", fade_in="", mode='blink')
+            ms=self._time_flashes(flashes,tap)
+        finally:
+            thing.apply(**saved)
+        self.blink["{:x}".format(thing.E4_TABLE[thing.MODES['blink']])]=ms
+        return ms
+
+    def blink_ms(self,mode='blink'):
+        return self.blink.get("{:x}".format(Thing.E4_TABLE[Thing.MODES[mode]]))
+
+def run_calibration(thing,args):
+    """
+    # --calibrate
+    """
+    thing.printer.flush()
+    cal=Calibration.load(args.calibration)
+    latency=cal.measure_latency(thing)
+    print("latency: inb={inb:.2f}us outb={outb:.2f}us frame={frame:.2f}us".format(**latency))
+    for observation in args.observation:
+        step,_,ms=observation.partition('=')
+        cal.add_observation(int(step),float(ms))
+    if stdin.isatty():
+        for step in map(int,args.calibrate_steps.split(',')):
+            print("step duration {}: press Enter at every red flash, 9 times".format(step))
+            print("  {:.1f}ms per frame".format(cal.observe(thing,step)))
+        print("blink: press Enter at every flash, 9 times")
+        print("  {:.1f}ms per blink".format(cal.observe_blink(thing)))
+    cal.save(args.calibration)
+    if cal.observations:
+        offset,slope=cal.fit()
+        print("frame = {:.2f}ms + {:.3f}ms * step duration".format(offset,slope))
+    return cal
+
+def play_program(thing,prog,fps):
+    """
+    # Plays a HwProgram in software, see program_frames().
+    """
+    thing.set(step_duration=prog.step_duration, fade_in="", mode='on')
+    animator=Animator(thing,fps)
+    try:
+        animator.run(cycle(program_frames(prog)))
+    finally:
+        if not thing.quiet:
+            thing.printer.print("anim: "+animator.report(),end="\n")
+            thing.printer.flush()
+    return animator
+
+def _numpy():
+    """
+    # numpy is only needed for the palette functions.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("numpy is needed for palettes; install it (dev-python/numpy)")
+    return numpy
+
+def _rgb_to_hsv(np,c):
+    mx=c.max(axis=1)
+    d=mx-c.min(axis=1)
+    safe_d=np.where(d > 0, d, 1)
+    r,g,b=c.T
+    h=np.where  (   mx == r, ((g-b)/safe_d) % 6,
+                    np.where( mx == g, (b-r)/safe_d+2, (r-g)/safe_d+4 )
+                ) / 6
+    h=np.where(d > 0, h, 0)
+    s=np.where(mx > 0, d/np.where(mx > 0, mx, 1), 0)
+    return np.stack((h,s,mx),axis=1)
+
+def _hsv_to_rgb(np,hsv):
+    h,s,v=hsv.T
+    i=np.floor(h*6)
+    f=h*6-i
+    i=i.astype(int) % 6
+    p=v*(1-s)
+    q=v*(1-f*s)
+    t=v*(1-(1-f)*s)
+    return np.stack ((
+                        np.choose(i,(v,q,p,p,t,v)),
+                        np.choose(i,(t,v,v,q,p,p)),
+                        np.choose(i,(p,p,t,v,v,q)),
+                    ),axis=1)
+
+def palette(colors,n,space='rgb',gamma=2.2,loop=False):
+    """
+    # n frames going through colors ((r,g,b) tuples, 0...255, evenly spaced),
+    # computed in one go with numpy. Returns an (n,3) uint8 array of
+    # the 4 bit intensities.
+    #
+    # space - 'rgb' interpolates in linear light,
+    #         'hsv' in HSV (hue the short way round)
+    # gamma - of the colours, the chip gets linear intensities; 1 disables
+    # loop  - interpolate from the last colour back to the first
+    """
+    np=_numpy()
+    stops=np.asarray(colors,dtype=float).reshape(-1,3)/255
+    if loop:
+        stops=np.concatenate((stops,stops[:1]))
+        x=np.arange(n)/n
+    else:
+        x=np.linspace(0,1,n)
+    xp=np.linspace(0,1,len(stops))
+    if space == 'rgb':
+        lin=stops**gamma
+        out=np.stack([ np.interp(x,xp,lin[:,ch]) for ch in range(3) ],axis=1)
+    elif space == 'hsv':
+        hsv=_rgb_to_hsv(np,stops)
+        hsv[1:,0]=hsv[0,0]+np.cumsum((np.diff(hsv[:,0])+0.5) % 1 - 0.5)
+        hsv=np.stack([ np.interp(x,xp,hsv[:,ch]) for ch in range(3) ],axis=1)
+        hsv[:,0]%=1
+        out=_hsv_to_rgb(np,hsv)**gamma
+    else:
+        raise Exception("unknown colour space "+repr(space))
+    return np.rint(np.clip(out,0,1)*15).astype(np.uint8)
+
+def palette_frames(nibbles):
+    """
+    # Frames for the Animator, one static colour per palette entry.
+    """
+    words=nibbles.astype('uint32')*0x11111111
+    for red,green,blue in words.tolist():
+        yield { 'red':red, 'green':green, 'blue':blue }
+
+def palette_words(nibbles):
+    """
+    # Packs every 8 palette entries into RR/GG/BB words for the
+    # hardware frames, like pack_frames(). Returns an (n/8,3) uint32 array.
+    """
+    np=_numpy()
+    if len(nibbles) % 8:
+        raise Exception("palette length needs to be a multiple of 8")
+    f=nibbles.reshape(-1,4,2,3).astype(np.uint32)
+    b=(f[:,:,1] << 4) | f[:,:,0]
+    return (b[:,0] << 24) | (b[:,1] << 16) | (b[:,2] << 8) | b[:,3]
+
+class Animator():
+    """
+    # Plays the frames of a frame generator at a fixed frame rate.
+    # Every frame has an absolute deadline (start + n * period),
+    # so the time spent writing does not make the animation drift.
+    # If a deadline is missed by whole periods, that many frames
+    # are dropped to catch up and counted in self.missed.
+    # A frame of None means nothing changed, nothing is written;
+    # of the dropped frames the last one which is not None is written.
+    # Frames go to thing.apply_frame(), or to apply if given.
+    """
+    def __init__(self,thing,fps,apply=None):
+        self.thing=thing
+        self.apply=thing.apply_frame if apply is None else apply
+        self.period=1/fps
+        self.frames=0
+        self.missed=0
+        self.max_late=0.0
+
+    def run(self,frames):
+        stop=self.thing.prog_stop
+        start=monotonic()
+        n=0
+        for frame in frames:
+            deadline=start+n*self.period
+            late=monotonic()-deadline
+            if late < 0:
+                if stop.wait(-late):
+                    break
+            else:
+                self.max_late=max(self.max_late,late)
+                skip=int(late/self.period)
+                if skip:
+                    for skipped in islice(frames,skip):
+                        if not skipped is None:
+                            frame=skipped
+                    self.missed+=skip
+                    n+=skip
+            if stop.is_set():
+                break
+            if not frame is None:
+                self.apply(frame)
+            self.frames+=1
+            n+=1
+
+    def report(self):
+        return "frames={} missed={} max_late={:.1f}ms".format(
+                                        self.frames, self.missed, self.max_late*1000 )
+
+class Ditherer():
+    """
+    # Shows 8 bit colours on the 4 bit channels, by switching each channel
+    # between the two neighbouring intensities (error diffusion over time).
+    # All 8 hardware frames get the same intensity, so every software
+    # frame is a static colour, written by a fast path: no preparation,
+    # only the cells of the channels which changed.
+    #
+    # The frame rate is what the measured cost of such a write allows,
+    # when writing may take the budget fraction of the time.
+    """
+    CELLS=( Thing.REDCELL, Thing.GREENCELL, Thing.BLUECELL )
+
+    def __init__(self,thing,budget=0.25,max_fps=1000):
+        self.thing=thing
+        self.budget=budget
+        self.max_fps=max_fps
+        self.cost=None
+        self.animator=None
+        self._last=None
+        # per channel the 4 (cell, index into the shadow copy)
+        self._cells=[ [ (cell+i, thing.RGB_BANK_CELLS.index(cell+i)) for i in range(4) ]
+                      for cell in self.CELLS ]
+
+    def _write(self,nibbles):
+        """
+        # The fast path, the first write has to be done by write_data().
+        """
+        thing=self.thing
+        dev=thing.dev
+        dev.select_bank( thing.RGB_BANK )
+        shadow=thing._shadow
+        last=self._last
+        for ch in range(3):
+            n=nibbles[ch]
+            if n != last[ch]:
+                b=n*0x11
+                for cell,i in self._cells[ch]:
+                    if shadow[i] != b:
+                        dev._write_byte_to_cell( cell, b )
+                        shadow[i]=b
+                last[ch]=n
+
+    def _start(self):
+        thing=self.thing
+        thing.write_data()
+        self._last=[ thing.state[c] & 0xf for c in ('red','green','blue') ]
+        thing.set_color(*( n*0x11111111 for n in self._last ))
+        thing.write_data()
+
+    def measure(self,n=50):
+        """
+        # Seconds per frame write, worst case (all channels change).
+        """
+        self._start()
+        first=list(self._last)
+        t0=perf_counter()
+        for i in range(n):
+            self._write([ (x+1+i%2) & 0xf for x in first ])
+        self.cost=(perf_counter()-t0)/n
+        self._write(first)
+        return self.cost
+
+    def fps(self):
+        if self.cost is None:
+            self.measure()
+        return min(self.max_fps,self.budget/self.cost) if self.cost > 0 else self.max_fps
+
+    def frames(self,red,green,blue):
+        """
+        # Intensity triples for the 8 bit colour, endless.
+        """
+        want=[ c*15/255 for c in (red,green,blue) ]
+        err=[0.0,0.0,0.0]
+        while True:
+            out=[]
+            for ch in range(3):
+                n=max(0,min(15,int(want[ch]+err[ch]+0.5)))
+                err[ch]+=want[ch]-n
+                out.append(n)
+            yield out
+
+    def run(self,red,green,blue,fps=None):
+        """
+        # Dithers until thing.prog_stop is set, returns the Animator.
+        """
+        fps=fps or self.fps()
+        if self._last is None:
+            self._start()
+        self.animator=Animator(self.thing,fps,apply=self._write)
+        try:
+            self.animator.run(self.frames(red,green,blue))
+        finally:
+            self.thing.set_color(*( n*0x11111111 for n in self._last ))
+        return self.animator
+
+def _running_loop():
+    """
+    # asyncio.get_running_loop(), which is new in python 3.7;
+    # in a coroutine get_event_loop() is the same on 3.6.
+    """
+    try:
+        from asyncio import get_running_loop
+    except ImportError:
+        from asyncio import get_event_loop as get_running_loop
+    return get_running_loop()
+
+class AsyncThing():
+    """
+    # asyncio front end of a Thing.
+    # The port I/O runs in a single executor thread.
+    # Settings requested while a write is running are merged (latest wins),
+    # so at most one write is queued, however many requests come in.
+    # Each request is checked (Thing.canonical_settings()) before it is
+    # merged, so a bad one fails alone and does not fail the others.
+    """
+    def __init__(self,thing):
+        from concurrent.futures import ThreadPoolExecutor
+        self.thing=thing
+        self.executor=ThreadPoolExecutor(max_workers=1)
+        self._pending={}
+        self._pending_done=None
+        self._writer=None
+
+    def request(self,**settings):
+        """
+        # Queues settings (see Thing.set()) without waiting.
+        # Returns a future, done when they (or newer ones) are written.
+        """
+        from asyncio import ensure_future
+        self._pending.update(Thing.canonical_settings(settings))
+        if self._pending_done is None:
+            self._pending_done=_running_loop().create_future()
+        done=self._pending_done
+        if self._writer is None or self._writer.done():
+            self._writer=ensure_future(self._write_pending())
+        return done
+
+    async def apply(self,**settings):
+        """
+        # Queues settings and waits until they are written.
+        """
+        from asyncio import shield
+        await shield(self.request(**settings))
+
+    async def _write_pending(self):
+        loop=_running_loop()
+        while self._pending:
+            settings,self._pending=self._pending,{}
+            done,self._pending_done=self._pending_done,None
+            try:
+                await loop.run_in_executor(self.executor,partial(self.thing.apply,**settings))
+            except Exception as e:
+                done.set_exception(e)
+            else:
+                done.set_result(None)
+
+    async def fade(self,duration,fps=30,**target):
+        """
+        # Goes from the current colours to the target colours
+        # (red, green, blue) in duration seconds, other settings
+        # are applied at the start. Frames the port can not keep up
+        # with are merged away.
+        """
+        from asyncio import sleep as async_sleep
+        colors={ c:target.pop(c) for c in ('red','green','blue') if c in target }
+        start_colors={ c:self.thing.state[c] for c in colors }
+        if self._pending:
+            start_colors.update({ c:self._pending[c] for c in colors if c in self._pending })
+        if target:
+            self.request(**target)
+        loop=_running_loop()
+        steps=max(1,int(duration*fps))
+        t0=loop.time()
+        for i in range(1,steps):
+            f=i/steps
+            self.request(**{ c:blend_words(start_colors[c],colors[c],f) for c in colors })
+            delay=t0+i/fps-loop.time()
+            if delay > 0:
+                await async_sleep(delay)
+        await self.apply(**colors)
+
+    async def close(self):
+        if not self._writer is None:
+            await self._writer
+        await _running_loop().run_in_executor(self.executor,self.thing.close)
+        self.executor.shutdown()
+
+def replay_trace(records,portfile,speed=1.0):
+    """
+    # Plays the records of a trace (Thing.Tracer.load()) against a port file
+    # or SimulatedChip. speed 1 keeps the original timing, 0 goes as fast
+    # as possible. The values read are compared with the recorded ones.
+    # Returns a dict with the counts and the time it took.
+    """
+    fd,port_pread,port_pwrite=Thing.Device.open_port(portfile)
+    result={ 'reads':0, 'writes':0, 'read_mismatches':0 }
+    try:
+        t0=perf_counter()
+        if records:
+            trace_t0=records[0][0]
+        for t,port,direction,value in records:
+            if speed:
+                delay=t0+(t-trace_t0)/speed-perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            if direction:
+                port_pwrite(bytes((value,)),port)
+                result['writes']+=1
+            else:
+                result['reads']+=1
+                if port_pread(1,port)[0] != value:
+                    result['read_mismatches']+=1
+        result['seconds']=perf_counter()-t0
+    finally:
+        Thing.Device.close_port(fd)
+    return result
+
+class SceneStore():
+    """
+    # Compiled scenes in one file, read through mmap.
+    # Every scene is one or more register images (several for progs).
+    #
+    # Layout: HEADER (magic, version, number of slots, number of images),
+    # then the hash table of SLOTs (name, first image, image count, fps),
+    # then the images. A name is found at crc32(name) modulo the number
+    # of slots (a power of two), or in one of the following slots.
+    # Empty slots have an image count of 0.
+    """
+    MAGIC=b'MSIS'
+    VERSION=1
+    HEADER='<4sHHI'
+    SLOT='<32sIHf'
+    NAME_SIZE=32
+    IMAGE_SIZE=len(Thing.RGB_BANK_CELLS)
+
+    def __init__(self,path):
+        try:
+            with open(path,'rb') as f:
+                self.mm=mmap(f.fileno(),0,access=ACCESS_READ)
+        except OSError:
+            raise Exception("could not open the scene store \""+path+"\"; see --scene-compile")
+        magic,version,self.slots,self.images=unpack_from(self.HEADER,self.mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise Exception("\""+path+"\" is no scene store")
+        self.slot_size=calcsize(self.SLOT)
+        self.slots_offset=calcsize(self.HEADER)
+        self.images_offset=self.slots_offset+self.slots*self.slot_size
+
+    def find(self,name):
+        """
+        # (first image, image count, fps) of a scene, or None.
+        """
+        key=name.encode()
+        i=crc32(key) & (self.slots-1)
+        for probe in range(self.slots):
+            slot_name,first,count,fps=unpack_from(
+                                self.SLOT,self.mm,self.slots_offset+i*self.slot_size)
+            if count == 0:
+                return None
+            if slot_name.rstrip(b'\0') == key:
+                return first,count,fps
+            i=(i+1) & (self.slots-1)
+        return None
+
+    def image(self,index):
+        offset=self.images_offset+index*self.IMAGE_SIZE
+        return self.mm[offset:offset+self.IMAGE_SIZE]
+
+    def entries(self):
+        """
+        # [(name, image count, fps)], sorted by name.
+        """
+        entries=[]
+        for i in range(self.slots):
+            name,first,count,fps=unpack_from(self.SLOT,self.mm,self.slots_offset+i*self.slot_size)
+            if count:
+                entries.append((name.rstrip(b'\0').decode(),count,fps))
+        return sorted(entries)
+
+    def close(self):
+        self.mm.close()
+
+    @classmethod
+    def write(cls,path,scenes):
+        """
+        # scenes is a list of (name, [images], fps).
+        """
+        slots=8
+        while slots < 2*len(scenes):
+            slots*=2
+        table=[None]*slots
+        images=[]
+        for name,scene_images,fps in scenes:
+            key=name.encode()
+            if not 0 < len(key) <= cls.NAME_SIZE:
+                raise Exception("scene names need 1 to 32 bytes: "+repr(name))
+            i=crc32(key) & (slots-1)
+            while not table[i] is None:
+                if table[i][0] == key:
+                    raise Exception("scene defined twice: "+repr(name))
+                i=(i+1) & (slots-1)
+            table[i]=(key,len(images),len(scene_images),fps)
+            images+=scene_images
+        out=bytearray(pack(cls.HEADER,cls.MAGIC,cls.VERSION,slots,len(images)))
+        for slot in table:
+            out+=pack(cls.SLOT,*(slot or (b'',0,0,0)))
+        for image in images:
+            out+=image
+        makedirs(dirname(path) or ".",exist_ok=True)
+        tmp=path+".tmp"
+        with open(tmp,'wb') as f:
+            f.write(out)
+        replace(tmp,path)
+
+def compile_scenes(lines,path):
+    """
+    # Compiles scene definitions (see --scene-compile) into a SceneStore.
+    # The settings are worked out on a simulated chip, like on the cmdline.
+    """
+    from shlex import split as shlex_split
+    parser=make_parser()
+    scenes=[]
+    for line in lines:
+        line=line.split('#',1)[0].strip()
+        if not line:
+            continue
+        name,sep,options=line.partition(':')
+        if not sep:
+            raise Exception("scene lines need to be \"name: options\", got "+repr(line))
+        a=parser.parse_args(shlex_split(options))
+        a.simulate=True
+        a.quiet=True
+        thing=Thing(args=a)
+        try:
+            if not a.anim is None:
+                calibration=None if a.duration_ms is None else Calibration.load(a.calibration)
+                apply_program(thing,parse_animation(a.anim,a.step_duration,a.fade_in,
+                                    duration_ms=a.duration_ms,calibration=calibration))
+            if a.prog is None:
+                thing._calc_data()
+                scenes.append((name.strip(),[thing.data['image']],0))
+                continue
+            images=[]
+            for frame in islice(progs[a.prog](thing),a.frames):
+                if not frame is None:
+                    thing.set(**frame)
+                thing._calc_data()
+                images.append(thing.data['image'])
+            scenes.append((name.strip(),images,a.fps or progs[a.prog].fps))
+        finally:
+            thing.close()
+    SceneStore.write(path,scenes)
+    return scenes
+
+def run_scene(thing,store,name,fps=None):
+    """
+    # Applies a scene of the store, plays it if it has several images.
+    """
+    found=store.find(name)
+    if found is None:
+        raise Exception("no scene "+repr(name)+" in the scene store")
+    first,count,scene_fps=found
+    if count == 1:
+        thing.apply_image(store.image(first))
+        return
+    images=cycle([ store.image(first+i) for i in range(count) ])
+    animator=Animator(thing,fps or scene_fps,apply=thing.apply_image)
+    try:
+        animator.run(images)
+    finally:
+        if not thing.quiet:
+            thing.printer.print("scene "+name+": "+animator.report(),end="\n")
+            thing.printer.flush()
+
+def run_prog(thing,name,fps=None):
+    """
+    # Runs one of the progs until it ends or thing.prog_stop is set.
+    """
+    prog=progs[name]
+    animator=Animator(thing,fps or prog.fps)
+    try:
+        animator.run(prog(thing))
+    finally:
+        if not thing.quiet:
+            thing.printer.print("prog "+name+": "+animator.report(),end="\n")
+            thing.printer.flush()
+    return animator
+
+class _Discard():
+    def print(self,*z,**zz):
+        pass
+
+def benchmark(thing,iterations=1000):
+    """
+    # Measures the main entry points of thing.
+    # Each entry point is called once with counting wrappers around
+    # the port operations (_inb/_outb) and the pread/pwrite calls,
+    # then `iterations` calls without wrappers are timed.
+    # Returns a dict, entry point -> results.
+    """
+    dev=thing.dev
+    colors=cycle((0x11111111,0x22222222))
+    frames=progs['1'](thing)
+
+    def write_data_change():
+        thing.set_color(red=next(colors))
+        thing.write_data()
+
+    def check_hardware():
+        thing._hardware_ckecked_and_ok=False
+        thing._check_hardware()
+
+    def init_pulsing():
+        thing._pulsing_initialized=False
+        thing._init_pulsing()
+
+    def prog_frame():
+        thing.apply_frame(next(frames))
+
+    entry_points=(
+                    ('write_data',          thing.write_data),
+                    ('write_data_change',   write_data_change),
+                    ('write_data_force',    partial(thing.write_data,force=True)),
+                    ('print_all',           dev.print_all),
+                    ('check_hardware',      check_hardware),
+                    ('init_pulsing',        init_pulsing),
+                    ('prog_1_frame',        prog_frame),
+                )
+
+    counts={}
+    def counting(name,f):
+        def wrapper(*z):
+            counts[name]+=1
+            return f(*z)
+        return wrapper
+
+    printer=dev.printer
+    dev.printer=_Discard()
+    results={}
+    try:
+        thing.write_data()
+        for name,f in entry_points:
+            counts.update(inb=0,outb=0,pread=0,pwrite=0)
+            saved={ name:dev.__dict__.get(name) for name in ('_inb','_outb') }
+            pread,pwrite=dev._pread,dev._pwrite
+            dev._inb=counting('inb',dev._inb)
+            dev._outb=counting('outb',dev._outb)
+            dev._pread=counting('pread',pread)
+            dev._pwrite=counting('pwrite',pwrite)
+            try:
+                f()
+            finally:
+                for attr,method in saved.items():
+                    if method is None:
+                        delattr(dev,attr)
+                    else:
+                        setattr(dev,attr,method)
+                dev._pread,dev._pwrite=pread,pwrite
+            t0=perf_counter()
+            for i in range(iterations):
+                f()
+            t=perf_counter()-t0
+            results[name]={
+                            'inb'           : counts['inb'],
+                            'outb'          : counts['outb'],
+                            'syscalls'      : counts['pread']+counts['pwrite'],
+                            'us_per_call'   : t/iterations*1e6,
+                            'calls_per_s'   : iterations/t if t > 0 else None,
+                          }
+    finally:
+        dev.printer=printer
+    return results
+
+def run_benchmark(thing,args):
+    """
+    # --bench, prints the results, saves and compares them.
+    """
+    from json import dump, load
+    from platform import python_version
+    thing.printer.flush()
+    results=benchmark(thing,args.bench_iterations)
+    baseline={}
+    if not args.bench_baseline is None:
+        with open(args.bench_baseline) as f:
+            baseline=load(f)['results']
+    print("{:20s} {:>5s} {:>5s} {:>8s} {:>10s} {:>10s}".format(
+                        "entry point","inb","outb","syscalls","us/call","calls/s"))
+    for name,r in results.items():
+        line="{:20s} {:5d} {:5d} {:8d} {:10.2f} {:10.0f}".format(
+                        name,r['inb'],r['outb'],r['syscalls'],r['us_per_call'],r['calls_per_s'] or 0)
+        b=baseline.get(name)
+        if b:
+            line+="  ({:+d} ops, x{:.2f} time)".format(
+                        r['inb']+r['outb']-b['inb']-b['outb'],
+                        r['us_per_call']/b['us_per_call'] if b['us_per_call'] else 0)
+        print(line)
+    if not args.bench_output is None:
+        with open(args.bench_output,'w') as f:
+            dump    ({
+                        'version'       : __version__,
+                        'python'        : python_version(),
+                        'backend'       : type(thing.dev.fd).__name__,
+                        'iterations'    : args.bench_iterations,
+                        'time'          : time(),
+                        'results'       : results,
+                    },f,indent=1)
+    return results
+
+class Daemon():
+    """
+    # Owns one Thing and takes line based commands over a unix socket.
+    # Every command line gets one reply line, "ok" or "error <reason>".
+    # A prog runs in a thread until the next command.
+    # Each connection has its own thread, the commands run one at a time.
+    # A connection idle for client_timeout seconds is closed.
+    """
+    client_timeout=30
+
+    def __init__(self,thing,socketpath):
+        self.thing=thing
+        self.socketpath=socketpath
+        self.prog_thread=None
+        self.lock=Lock()
+
+    def handle(self,rfile,wfile):
+        """
+        # One connection, command lines in, reply lines out.
+        """
+        try:
+            for line in rfile:
+                try:
+                    with self.lock:
+                        reply=self.command(line.decode().split())
+                except Exception as e:
+                    reply="error "+str(e)
+                wfile.write((reply+"\n").encode())
+                if self.quit:
+                    return
+        except OSError:
+            pass # timed out or gone
+
+    def serve(self):
+        from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+        daemon=self
+        class Handler(StreamRequestHandler):
+            timeout=self.client_timeout
+            def handle(self):
+                daemon.handle(self.rfile,self.wfile)
+        try:
+            unlink(self.socketpath)
+        except FileNotFoundError:
+            pass
+        self.quit=False
+        self.server=ThreadingUnixStreamServer(self.socketpath,Handler)
+        self.server.daemon_threads=True
+        self.server.timeout=0.5 # to see quit
+        chmod(self.socketpath,0o600)
+        signal(SIGTERM,lambda signum,frame: exit())
+        try:
+            while not self.quit:
+                self.server.handle_request()
+        finally:
+            self.stop_prog()
+            self.server.server_close()
+            unlink(self.socketpath)
+
+    def stop_prog(self):
+        if self.prog_thread is None:
+            return
+        self.thing.prog_stop.set()
+        self.prog_thread.join()
+        self.prog_thread=None
+        self.thing.prog_stop.clear()
+
+    def command(self,words):
+        if not words:
+            raise Exception("empty command")
+        cmd,params=words[0],words[1:]
+        handler=getattr(self,"cmd_"+cmd,None)
+        if handler is None:
+            raise Exception("unknown command "+repr(cmd))
+        self.stop_prog()
+        handler(*params)
+        return "ok"
+
+    def cmd_color(self,red,green,blue):
+        self.thing.set_color(int(red,base=16),int(green,base=16),int(blue,base=16))
+        self.thing.write_data()
+
+    def cmd_mode(self,mode):
+        self.thing.set_mode(mode)
+        self.thing.write_data()
+
+    def cmd_prog(self,name):
+        if not name in progs:
+            raise Exception("unknown prog "+repr(name))
+        self.prog_thread=Thread(target=run_prog,args=(self.thing,name),daemon=True)
+        self.prog_thread.start()
+
+    def cmd_stop(self):
+        pass
+
+    def cmd_quit(self):
+        self.quit=True
+
+def send_command(socketpath,command,timeout=5):
+    """
+    # Sends one command line to the daemon, returns the reply line.
+    """
+    from socket import socket, AF_UNIX, SOCK_STREAM, timeout as socket_timeout
+    with socket(AF_UNIX,SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        try:
+            s.connect(socketpath)
+        except socket_timeout:
+            raise Exception("no answer from the daemon at \""+socketpath+"\"")
+        except OSError:
+            raise Exception("could not connect to \""+socketpath+"\"; daemon running?")
+        s.sendall((command+"\n").encode())
+        reply=b''
+        try:
+            while not reply.endswith(b'\n'):
+                d=s.recv(4096)
+                if not d:
+                    break
+                reply+=d
+        except socket_timeout:
+            raise Exception("no reply from the daemon within {}s".format(timeout))
+    return reply.decode().strip()
+
+class CommandRing():
+    """
+    # Shared memory through which producer processes queue settings
+    # (see Thing.set()) for one RingWriter, the only one to touch the device.
+    #
+    # Layout: HEADER (magic, version, number of slots), then one SLOT
+    # per producer: (head, tail, priority, pid) and a ring of RING_SIZE
+    # RECORDs. A producer claims a free slot by locking its first byte
+    # (lockf, released by the kernel when the producer dies).
+    # Only the producer writes head, only the writer writes tail,
+    # so neither ever waits for the other. The record is written before
+    # head is advanced; this relies on stores becoming visible in order,
+    # as they do on x86.
+    #
+    # A record has a mask of the settings it carries, CLAIM and RELEASE
+    # mark the start and the end of a producer.
+    # The writer holds a lock on the first byte of the header.
+    """
+    MAGIC=b'MSIQ'
+    VERSION=1
+    HEADER='<4sHH'
+    SLOT_HEADER='<IIiI'
+    RECORD='<HHIIIBBBx'
+    RING_SIZE=64
+    FIELDS=Thing.SETTINGS
+    CLAIM=1 << 7
+    RELEASE=1 << 8
+    MODE_NAMES=tuple(Thing.MODES)
+
+    def __init__(self,path,create=False,slots=16):
+        self.header_size=calcsize(self.HEADER)
+        self.record_size=calcsize(self.RECORD)
+        self.slot_size=calcsize(self.SLOT_HEADER)+self.RING_SIZE*self.record_size
+        flags = O_RDWR | O_CREAT if create else O_RDWR
+        try:
+            self.fd=os_open(path,flags,0o600)
+        except OSError:
+            raise Exception("could not open the ring \""+path+"\"; ring writer running?")
+        if create:
+            self._become_writer(slots)
+        self.mm=mmap(self.fd,0)
+        magic,version,self.slots=unpack_from(self.HEADER,self.mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise Exception("\""+path+"\" is no command ring")
+        self.slot=None
+        self.pending={}
+
+    def _become_writer(self,slots):
+        """
+        # The writer locks the first byte of the header, there can be only one.
+        # A ring which is still valid is kept, with what the producers queued.
+        """
+        try:
+            lockf(self.fd,LOCK_EX | LOCK_NB,1,0)
+        except OSError:
+            os_close(self.fd)
+            raise Exception("another ring writer is running")
+        size=self.header_size+slots*self.slot_size
+        header=pread(self.fd,self.header_size,0)
+        if fstat(self.fd).st_size == size and len(header) == self.header_size \
+                and unpack_from(self.HEADER,header) == (self.MAGIC,self.VERSION,slots):
+            return
+        ftruncate(self.fd,0)
+        ftruncate(self.fd,size)
+        pwrite(self.fd,pack(self.HEADER,self.MAGIC,self.VERSION,slots),0)
+
+    def _slot_offset(self,slot):
+        return self.header_size+slot*self.slot_size
+
+    def slot_header(self,slot):
+        """
+        # (head, tail, priority, pid)
+        """
+        return unpack_from(self.SLOT_HEADER,self.mm,self._slot_offset(slot))
+
+    def lock_slot(self,slot):
+        """
+        # True if the slot was free and is now locked.
+        """
+        try:
+            lockf(self.fd,LOCK_EX | LOCK_NB,1,self._slot_offset(slot))
+        except OSError:
+            return False
+        return True
+
+    def unlock_slot(self,slot):
+        lockf(self.fd,LOCK_UN,1,self._slot_offset(slot))
+
+    def set_owner(self,slot,priority,pid):
+        pack_into('<iI',self.mm,self._slot_offset(slot)+8,priority,pid)
+
+    # producer side
+
+    def claim(self,priority=0):
+        """
+        # Takes a free slot. Settings of higher priorities win.
+        """
+        for slot in range(self.slots):
+            if self.lock_slot(slot):
+                self.slot=slot
+                self.set_owner(slot,priority,getpid())
+                self._publish({},self.CLAIM)
+                return slot
+        raise Exception("all "+str(self.slots)+" slots of the ring are taken")
+
+    def _publish(self,settings,flags=0):
+        """
+        # Appends one record, False if the ring is full.
+        """
+        offset=self._slot_offset(self.slot)
+        head,tail=unpack_from('<II',self.mm,offset)
+        if head-tail & 0xffffffff >= self.RING_SIZE:
+            return False
+        mask=flags
+        for i,field in enumerate(self.FIELDS):
+            if field in settings:
+                mask |= 1 << i
+        get=settings.get
+        pack_into   (
+                        self.RECORD,self.mm,
+                        offset+calcsize(self.SLOT_HEADER)+head % self.RING_SIZE*self.record_size,
+                        mask,get('step_duration',0),
+                        get('red',0),get('green',0),get('blue',0),
+                        Thing.CHANNEL_MASKS[get('invert',"")],
+                        Thing.CHANNEL_MASKS[get('fade_in',"")],
+                        Thing.MODES[get('mode','on')],
+                    )
+        pack_into('<I',self.mm,offset,head+1 & 0xffffffff)
+        return True
+
+    def send(self,**settings):
+        """
+        # Queues settings, never waits. If the ring is full they are
+        # merged with what is still pending and go with the next send()
+        # or flush(). Returns False if something is pending.
+        """
+        settings=Thing.canonical_settings(settings)
+        self.pending.update(settings)
+        return self.flush()
+
+    def flush(self):
+        if self.pending and self._publish(self.pending):
+            self.pending={}
+        return not self.pending
+
+    def release(self):
+        """
+        # Drops the settings of this producer and frees the slot.
+        # Without this (or when the producer dies) the settings stay.
+        """
+        if self.slot is None:
+            return
+        self.pending={}
+        while not self._publish({},self.RELEASE):
+            sleep(0.001) # the writer is behind, only at the end
+        self.set_owner(self.slot,0,0)
+        self.unlock_slot(self.slot)
+        self.slot=None
+
+    def close(self):
+        if not self.slot is None:
+            self.flush()
+        self.mm.close()
+        os_close(self.fd) # frees a claimed slot, the settings stay
+
+    # writer side
+
+    def records(self,slot):
+        """
+        # Takes the queued records of a slot, as (flags, settings).
+        """
+        offset=self._slot_offset(slot)
+        head,tail=unpack_from('<II',self.mm,offset)
+        records=[]
+        ring=offset+calcsize(self.SLOT_HEADER)
+        while tail != head:
+            mask,step,red,green,blue,inv,fade,mode=unpack_from(
+                        self.RECORD,self.mm,ring+tail % self.RING_SIZE*self.record_size)
+            values=( red,green,blue,Thing.CHANNELS_OF_MASK[inv],Thing.CHANNELS_OF_MASK[fade],
+                     step,self.MODE_NAMES[mode] )
+            records.append(( mask & (self.CLAIM | self.RELEASE),
+                             { f:v for i,(f,v) in enumerate(zip(self.FIELDS,values))
+                               if mask >> i & 1 } ))
+            tail=tail+1 & 0xffffffff
+        pack_into('<I',self.mm,offset+4,tail)
+        return records
+
+class RingWriter():
+    """
+    # Owns the Thing and writes what the producers queue in a CommandRing.
+    # Each producer has its own settings, coalesced from its records.
+    # What is written is the base settings, overlaid by the settings of
+    # the producers, lowest priority first. When a producer ends without
+    # release() (e.g. a one-shot --ring-send), its settings become part
+    # of the base. All that is queued is written with one write_data().
+    """
+    def __init__(self,thing,ring,interval=0.005,liveness=0.5):
+        self.thing=thing
+        self.ring=ring
+        self.interval=interval
+        self.liveness=liveness
+        self.base=dict(thing.state)
+        self.producers={} # slot -> settings
+        self.writes=0
+
+    def _end(self,slot,keep):
+        settings=self.producers.pop(slot,None)
+        if keep and settings:
+            self.base.update(settings)
+
+    def _check_producers(self):
+        """
+        # Producers which died keep their settings, as the base.
+        """
+        changed=False
+        for slot in list(self.producers):
+            if self.ring.lock_slot(slot):
+                self._collect(slot)
+                if slot in self.producers:
+                    self._end(slot,keep=True)
+                    changed=True
+                self.ring.set_owner(slot,0,0)
+                self.ring.unlock_slot(slot)
+        return changed
+
+    def _collect(self,slot):
+        records=self.ring.records(slot)
+        for flags,settings in records:
+            if flags & CommandRing.CLAIM:
+                self._end(slot,keep=True) # what the previous owner left behind
+                self.producers[slot]={}
+            if settings:
+                self.producers.setdefault(slot,{}).update(settings)
+            if flags & CommandRing.RELEASE:
+                self._end(slot,keep=False)
+        return bool(records)
+
+    def settings(self):
+        settings=dict(self.base)
+        order=sorted(self.producers,key=lambda slot: (self.ring.slot_header(slot)[2],slot))
+        for slot in order:
+            settings.update(self.producers[slot])
+        return settings
+
+    def poll(self,check_producers=False):
+        """
+        # Takes everything queued, writes if that changed anything.
+        """
+        changed=False
+        for slot in range(self.ring.slots):
+            changed|=self._collect(slot)
+        if check_producers:
+            changed|=self._check_producers()
+        if changed:
+            self.thing.set(**self.settings())
+            self.thing.write_data()
+            self.writes+=1
+        return changed
+
+    def run(self):
+        """
+        # Polls until thing.prog_stop is set.
+        """
+        stop=self.thing.prog_stop
+        next_check=monotonic()
+        while not stop.is_set():
+            now=monotonic()
+            check=now >= next_check
+            if check:
+                next_check=now+self.liveness
+            if not self.poll(check):
+                stop.wait(self.interval)
+
+def ring_send(path,settings,priority=0,hold=0):
+    """
+    # Queues settings for the ring writer. With hold they are
+    # dropped again after hold seconds, otherwise they stay.
+    """
+    ring=CommandRing(path)
+    try:
+        ring.claim(priority)
+        while not ring.send(**settings):
+            sleep(0.001)
+        if hold:
+            sleep(hold)
+            ring.release()
+    finally:
+        ring.close()
 
 def init():
     parse_args()
@@ -682,34 +3237,334 @@ def main():
     init()
 
     if args.show:
+        from pprint import pprint
         pprint(progs)
+        try:
+            store=SceneStore(args.scene_store)
+        except Exception:
+            exit()
+        for name,count,fps in store.entries():
+            print("{}: {} image(s){}".format(name,count," at {:g} fps".format(fps) if fps else ""))
+        exit()
+
+    if not args.scene_compile is None:
+        with open(args.scene_compile) as f:
+            scenes=compile_scenes(f,args.scene_store)
+        if not args.quiet:
+            print("{} scene(s) compiled into {}".format(len(scenes),args.scene_store))
         exit()
 
+    anim_in_software=False
+    if not args.anim is None:
+        step_duration=args.step_duration
+        duration_ms=args.duration_ms
+        calibration=None
+        if not ( args.fps is None and duration_ms is None ):
+            calibration=Calibration.load(args.calibration)
+            if not calibration.observations:
+                print("anim: no calibration (see --calibrate), using --step-duration",file=stderr)
+                calibration=duration_ms=None
+        if not calibration is None and duration_ms is None:
+            how,step=calibration.playback(args.fps)
+            anim_in_software = how == 'software'
+            if not step is None:
+                step_duration=step
+            if not args.quiet:
+                print("anim: {} fps in {}".format(args.fps,how))
+        anim=parse_animation(args.anim,step_duration,args.fade_in,
+                             duration_ms=duration_ms,calibration=calibration)
+        mode=Thing.settings_of_args(args)['mode']
+        if not program_mode(anim) in (None,mode) and mode != 'on':
+            raise Exception("--anim "+args.anim.partition(':')[0]+" needs the mode "
+                            +program_mode(anim)+", not --"+mode)
+        if not args.quiet:
+            print("anim: red={:08x} green={:08x} blue={:08x} error={:.1f}".format(
+                                anim.red,anim.green,anim.blue,anim.error))
+
+    if not args.diff is None:
+        snapshots=[]
+        for path in args.diff:
+            with open(path,'rb') as f:
+                snapshots.append(Thing.Snapshot.load(f.read()))
+        changes=snapshots[0].diff(snapshots[1])
+        for bank,reg,old,new in changes:
+            print("{:02x}:{:02x} {} -> {}".format(bank,reg,
+                        "--" if old is None else "{:02x}".format(old),
+                        "--" if new is None else "{:02x}".format(new)))
+        exit(1 if changes else 0)
+
+    if not args.send is None:
+        reply=send_command(args.socket,args.send)
+        print(reply)
+        exit(0 if reply == "ok" else 1)
+
+    if args.ring_send:
+        try:
+            ring_send(args.ring,Thing.settings_of_args(args),args.priority,args.hold)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
+    if not args.replay is None:
+        with open(args.replay,'rb') as f:
+            records=Thing.Tracer.load(f.read())
+        if args.simulate:
+            portfile=Thing.SimulatedChip(int(args.base_port,base=16))
+        else:
+            portfile=Thing.testing_portfilepath
+        result=replay_trace(records,portfile,args.replay_speed)
+        print(" ".join( "{}={}".format(k,v) for k,v in result.items() ))
+        exit(1 if result['read_mismatches'] else 0)
+
     global thing
-    thing=Thing(args=args)
+    base_ports=[ int(p,base=16) for p in args.base_port.split(',') ]
+    if len(base_ports) > 1:
+        if args.stats or args.verbose or args.dump or args.bench or args.calibrate \
+                or not args.dither is None or not args.trace is None:
+            raise Exception("--stats, --verbose, --dump, --bench, --calibrate, --dither"
+                            " and --trace need a single --base_port")
+        thing=ThingGroup(base_ports,args=args)
+    else:
+        thing=Thing(args=args)
+
+    if args.stats:
+        stats=thing.dev.stats
+        atexit_register(stats.dump,args.stats_file)
+        signal(SIGUSR1,lambda signum,frame: stats.dump(args.stats_file))
     
+    if not args.anim is None:
+        apply_program(thing,anim)
+
     if args.verbose:
         thing.dev.print_all()
     
-    if args.prog is None:
+    if not args.dump is None:
+        try:
+            snapshot=thing.dev.dump_banks()
+        finally:
+            thing.close()
+        if args.dump == 'raw':
+            out=snapshot.to_raw()
+        elif args.dump == 'json':
+            out=(snapshot.to_json()+"\n").encode()
+        else:
+            out=(snapshot.to_hex()+"\n").encode()
+        if args.dump_file is None:
+            stdout.buffer.write(out)
+        else:
+            with open(args.dump_file,'wb') as f:
+                f.write(out)
+        return
+
+    if args.bench:
+        try:
+            run_benchmark(thing,args)
+        finally:
+            thing.close()
+        return
+
+    if args.calibrate:
+        try:
+            run_calibration(thing,args)
+        finally:
+            thing.close()
+        return
+
+    if args.daemon:
+        try:
+            Daemon(thing,args.socket).serve()
+        finally:
+            thing.close()
+        return
+
+    if args.ring_writer:
+        ring=CommandRing(args.ring,create=True)
+        signal(SIGTERM,lambda signum,frame: exit())
+        try:
+            thing.write_data()
+            RingWriter(thing,ring).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            thing.close()
+        return
+
+    if not args.scene is None:
+        store=SceneStore(args.scene_store)
+        try:
+            run_scene(thing,store,args.scene,args.fps)
+        except KeyboardInterrupt:
+            pass
+    elif not args.dither is None:
+        color=int(args.dither,base=16)
+        ditherer=Ditherer(thing)
+        try:
+            ditherer.run(color >> 16 & 0xff, color >> 8 & 0xff, color & 0xff, args.fps)
+        except KeyboardInterrupt:
+            pass
+        if not args.quiet and not ditherer.animator is None:
+            thing.printer.print("dither: "+ditherer.animator.report(),end="\n")
+    elif anim_in_software:
+        try:
+            play_program(thing,anim,args.fps)
+        except KeyboardInterrupt:
+            pass
+    elif args.prog is None:
         thing.write_data()
     else:
-        progs[args.prog](thing)
+        try:
+            run_prog(thing,args.prog,args.fps)
+        except KeyboardInterrupt:
+            pass
 
-    thing.__del__()
+    thing.close()
+
+class Sensors():
+    """
+    # Reads system metrics from /sys and /proc.
+    # The files are opened once and read with pread, so a sample
+    # costs a few syscalls and no path lookups.
+    # A metric without any source reads as None.
+    """
+    def __init__(self,hwmon="/sys/class/hwmon",proc_stat="/proc/stat"):
+        self.temp_fds=self._open_all(hwmon+"/hwmon*/temp*_input")
+        self.fan_fds=self._open_all(hwmon+"/hwmon*/fan*_input")
+        self.stat_fd=(self._open_all(proc_stat) or [None])[0]
+        self._cpu=None
+
+    @staticmethod
+    def _open_all(pattern):
+        from glob import glob
+        fds=[]
+        for path in sorted(glob(pattern)):
+            try:
+                fds.append(os_open(path,O_RDONLY))
+            except OSError:
+                pass
+        return fds
+
+    @staticmethod
+    def _read_int(fd):
+        try:
+            return int(pread(fd,32,0))
+        except (OSError,ValueError):
+            return None
+
+    def _max(self,fds):
+        values=[ v for v in map(self._read_int,fds) if not v is None ]
+        return max(values) if values else None
+
+    def temp(self):
+        """
+        # The hottest hwmon temperature in °C.
+        """
+        t=self._max(self.temp_fds)
+        return None if t is None else t/1000
+
+    def fan(self):
+        """
+        # The fastest fan in rpm.
+        """
+        return self._max(self.fan_fds)
+
+    def load(self):
+        """
+        # The busy share of all cpus (0..1) since the previous call.
+        """
+        if self.stat_fd is None:
+            return None
+        ticks=[ int(v) for v in pread(self.stat_fd,256,0).split(b'\n',1)[0].split()[1:] ]
+        total=sum(ticks)
+        idle=ticks[3]+(ticks[4] if len(ticks) > 4 else 0)
+        last,self._cpu=self._cpu,(total,idle)
+        if last is None or total == last[0]:
+            return None
+        return 1-(idle-last[1])/(total-last[0])
+
+    def close(self):
+        for fd in self.temp_fds+self.fan_fds+[self.stat_fd]:
+            if not fd is None:
+                os_close(fd)
+        self.temp_fds=self.fan_fds=[]
+        self.stat_fd=None
+
+class Quantizer():
+    """
+    # Maps a metric onto the 16 intensities, with hysteresis:
+    # the level only changes when the value is more than `margin`
+    # levels past the middle between two levels, so a value which
+    # jitters around a border does not make the colour flicker.
+    """
+    def __init__(self,low,high,margin=0.25):
+        self.low=low
+        self.scale=15/(high-low)
+        self.margin=margin
+        self.level=0
+
+    def __call__(self,value):
+        if value is None:
+            return self.level
+        level=min(15,max(0,(value-self.low)*self.scale))
+        if abs(level-self.level) > 0.5+self.margin:
+            self.level=min(15,max(0,round(level)))
+        return self.level
+
+# The progs are frame generators, see Animator.
+# Their fps attribute is the default frame rate.
 
 def internal_prog_1(thing):
     while True:
-        thing.args.invhalf="bg"
-        thing.args.red="00000000"
-        thing.args.green="00000000" 
-        thing.args.green="00000000"
-        thing.write_data()
-        sleep(1)
-        thing.args.invhalf="rb"
-        thing.write_data()
+        yield { 'invert':"bg", 'red':0, 'green':0, 'blue':0 }
+        yield { 'invert':"rb" }
+internal_prog_1.fps=1
+
+def internal_prog_2(thing):
+    """
+    # hue wheel, needs numpy
+    """
+    hues=[ (255,0,0), (0,255,0), (0,0,255) ]
+    return cycle(list(palette_frames(palette(hues,240,space='hsv',loop=True))))
+internal_prog_2.fps=30
+
+def internal_prog_3(thing,hold=1.0,budget=0.005):
+    """
+    # hardware monitor: red is the temperature (30-90°C),
+    # green the fan speed (0-3000rpm), blue the cpu load.
+    # A colour is only written when one of the levels changes,
+    # and at most once per `hold` seconds.
+    # Sampling takes at most the `budget` fraction of cpu time,
+    # if it costs more, samples are skipped.
+    """
+    sensors=Sensors()
+    metrics=( (sensors.temp,Quantizer(30,90)), (sensors.fan,Quantizer(0,3000)),
+              (sensors.load,Quantizer(0,1)) )
+    period=1/internal_prog_3.fps
+    levels=None
+    written=None
+    cost=0.0
+    skip=0
+    try:
+        while True:
+            if skip:
+                skip-=1
+                yield None
+                continue
+            t=process_time()
+            new=tuple( quantize(read()) for read,quantize in metrics )
+            cost=(cost+process_time()-t)/2
+            skip=max(0,ceil(cost/(period*budget))-1)
+            now=monotonic()
+            if new == levels or (not written is None and now-written < hold):
+                yield None
+                continue
+            levels=new
+            written=now
+            yield { channel:level*0x11111111 for channel,level in zip(('red','green','blue'),levels) }
+    finally:
+        sensors.close()
+internal_prog_3.fps=4
 
-progs={ "1" : internal_prog_1 }
+progs={ "1" : internal_prog_1, "2" : internal_prog_2, "3" : internal_prog_3 }
 
 if __name__=='__main__':
     main()